@@ -0,0 +1,116 @@
+from __future__ import print_function
+import os, glob, json, six
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
+
+# summarize timing reports from jobExecCondorChain.sh (enabled with createChain.py -T)
+# each report has one entry per phase: unpack, recover (from checkpoint), job0...jobN, checkpoint
+
+def find_reports(inputs):
+    files = []
+    for input in inputs:
+        if os.path.isdir(input): files.extend(sorted(glob.glob(os.path.join(input,"timing_*.json"))))
+        else: files.extend(sorted(glob.glob(input)))
+    return files
+
+def load_reports(files):
+    reports = []
+    incomplete = []
+    for fname in files:
+        try:
+            with open(fname) as rfile:
+                report = json.load(rfile)
+        except ValueError:
+            report = {}
+        # placeholder only: job was killed before the report was written
+        if "steps" not in report: incomplete.append(fname)
+        else: reports.append(report)
+    return reports, incomplete
+
+class stepSummary(object):
+    def __init__(self,step):
+        self.step = step
+        self.names = set()
+        self.walls = []
+        self.failed = 0
+        self.bytes = 0
+
+    def add(self,entry):
+        self.names.add(entry["name"])
+        self.walls.append(entry["wall"])
+        if entry["exit"]!=0: self.failed += 1
+        self.bytes += entry["bytes"]
+
+    def median(self):
+        walls = sorted(self.walls)
+        mid = len(walls)//2
+        return walls[mid] if len(walls)%2==1 else (walls[mid-1]+walls[mid])/2.
+
+    def to_dict(self,total):
+        return OrderedDict([
+            ("step", self.step),
+            ("names", sorted(self.names)),
+            ("count", len(self.walls)),
+            ("failed", self.failed),
+            ("total", sum(self.walls)),
+            ("mean", sum(self.walls)/len(self.walls)),
+            ("median", self.median()),
+            ("max", max(self.walls)),
+            ("fraction", sum(self.walls)/total if total>0 else 0.),
+            ("bytes", self.bytes),
+        ])
+
+# aggregate reports across all processes of each chain
+def summarize(reports):
+    chains = OrderedDict()
+    for report in sorted(reports, key=lambda r: (r["job"], int(r["process"]) if str(r["process"]).isdigit() else r["process"])):
+        chain = chains.setdefault(report["job"], OrderedDict([("processes",0),("failed",[]),("steps",OrderedDict())]))
+        chain["processes"] += 1
+        if report["exit"]!=0: chain["failed"].append(report["process"])
+        for entry in report["steps"]:
+            chain["steps"].setdefault(entry["step"], stepSummary(entry["step"])).add(entry)
+    summary = OrderedDict()
+    for job,chain in six.iteritems(chains):
+        total = sum(sum(step.walls) for step in six.itervalues(chain["steps"]))
+        summary[job] = OrderedDict([
+            ("processes", chain["processes"]),
+            ("failed", chain["failed"]),
+            ("total", total),
+            ("steps", [step.to_dict(total) for step in six.itervalues(chain["steps"])]),
+        ])
+    return summary
+
+def human_bytes(num):
+    for unit in ["B","kB","MB","GB","TB"]:
+        if abs(num)<1000. or unit=="TB": break
+        num /= 1000.
+    return "{:.1f} {}".format(num,unit) if unit!="B" else "{} B".format(int(num))
+
+def print_summary(summary, incomplete):
+    for job,chain in six.iteritems(summary):
+        print("Chain {}: {} process(es), {} failed, total wall time {:.1f} s".format(job,chain["processes"],len(chain["failed"]),chain["total"]))
+        if len(chain["failed"])>0: print("  failed processes: "+", ".join(str(proc) for proc in chain["failed"]))
+        fmt = "  {:<12} {:<24} {:>6} {:>6} {:>10} {:>10} {:>10} {:>7} {:>10}"
+        print(fmt.format("step","name","count","failed","mean [s]","median [s]","max [s]","frac","staged"))
+        for step in chain["steps"]:
+            print(fmt.format(
+                step["step"], ",".join(step["names"])[:24], step["count"], step["failed"],
+                "{:.1f}".format(step["mean"]), "{:.1f}".format(step["median"]), "{:.1f}".format(step["max"]),
+                "{:.1%}".format(step["fraction"]), human_bytes(step["bytes"]),
+            ))
+    if len(incomplete)>0:
+        print("{} incomplete report(s) (job killed before finishing):".format(len(incomplete)))
+        for fname in incomplete: print("  "+fname)
+
+if __name__=="__main__":
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("inputs", type=str, nargs='+', help="timing report files, patterns, or directories (e.g. timing_[name])")
+    parser.add_argument("-j", "--json", dest="json", type=str, default="", help="also write summary to this JSON file")
+    args = parser.parse_args()
+
+    reports, incomplete = load_reports(find_reports(args.inputs))
+    summary = summarize(reports)
+    print_summary(summary, incomplete)
+    if len(args.json)>0:
+        with open(args.json,'w') as jfile:
+            json.dump(summary, jfile, indent=2)
@@ -0,0 +1,66 @@
+import threading, time, six
+from six.moves import queue
+
+class TaskTimeout(Exception):
+    pass
+
+# run func(task) for each task using up to nthreads worker threads
+# yields (task, result, error) in order of completion (error is None if the task succeeded)
+# a task running for longer than timeout (in seconds) is abandoned and reported with a TaskTimeout error
+def run_tasks(func, tasks, nthreads=1, timeout=None):
+    tasks = list(tasks)
+    if len(tasks)==0: return
+    if timeout is not None and timeout<=0: timeout = None
+
+    todo = queue.Queue()
+    done = queue.Queue()
+    for itask in range(len(tasks)):
+        todo.put(itask)
+    started = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                itask = todo.get_nowait()
+            except queue.Empty:
+                return
+            with lock:
+                started[itask] = time.time()
+            try:
+                done.put((itask,func(tasks[itask]),None))
+            except Exception as e:
+                done.put((itask,None,e))
+
+    def spawn():
+        # daemon threads: a hung call does not prevent exit
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for ithread in range(min(max(nthreads,1),len(tasks))):
+        spawn()
+
+    finished = set()
+    while len(finished)<len(tasks):
+        wait = None
+        if timeout is not None:
+            now = time.time()
+            with lock:
+                running = [(itask,t0) for itask,t0 in six.iteritems(started) if itask not in finished]
+            expired = [itask for itask,t0 in running if now-t0>timeout]
+            for itask in expired:
+                finished.add(itask)
+                # the abandoned thread keeps its slot, so replace it
+                spawn()
+                yield tasks[itask], None, TaskTimeout("timed out after {} seconds".format(timeout))
+            if len(expired)>0: continue
+            wait = min([t0+timeout-now for itask,t0 in running]) if len(running)>0 else timeout
+        try:
+            itask, result, error = done.get(timeout=wait)
+        except queue.Empty:
+            continue
+        # ignore late results from abandoned tasks
+        if itask in finished: continue
+        finished.add(itask)
+        yield tasks[itask], result, error
@@ -1,6 +1,6 @@
-import os, shutil, tarfile, glob, six
+import os, re, shutil, tarfile, glob, hashlib, subprocess, six
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from collections import OrderedDict, Callable
+from collections import OrderedDict, Callable, defaultdict
 
 class DefaultOrderedDict(OrderedDict):
     # Source: http://stackoverflow.com/a/6190500/562769
@@ -42,12 +42,93 @@ class DefaultOrderedDict(OrderedDict):
     def __repr__(self):
         return "OrderedDefaultDict({}, {})".format(self.default_factory, super(DefaultOrderedDict, self).__repr__())
 
-def createChain(jdls,name,log,checkpoint):
+def sha1sum(fname):
+    sha1 = hashlib.sha1()
+    with open(fname,'rb') as file:
+        for chunk in iter(lambda: file.read(1<<20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# copies input files, storing identical files only once (duplicates are hard links to the first copy, if possible)
+# files are only hashed if another file has the same size
+class inputStore(object):
+    def __init__(self):
+        self.stored = defaultdict(list)
+        self.hashes = {}
+        self.nlinked = 0
+        self.saved = 0
+
+    def hash(self,fname):
+        if fname not in self.hashes: self.hashes[fname] = sha1sum(fname)
+        return self.hashes[fname]
+
+    def add(self,src,dstdir):
+        dst = os.path.join(dstdir,os.path.basename(src))
+        if os.path.lexists(dst):
+            for stored in six.itervalues(self.stored):
+                if dst in stored: stored.remove(dst)
+            self.hashes.pop(dst,None)
+            os.remove(dst)
+        size = os.path.getsize(src)
+        if len(self.stored[size])>0:
+            digest = self.hash(src)
+            for stored in self.stored[size]:
+                if self.hash(stored)==digest:
+                    try:
+                        os.link(stored,dst)
+                    except OSError:
+                        # hard links not supported (e.g. AFS, different device): copy instead
+                        break
+                    self.nlinked += 1
+                    self.saved += size
+                    return dst
+        shutil.copy2(src,dst)
+        self.stored[size].append(dst)
+        return dst
+
+# write a .tar.gz, using parallel compression (pigz) if available
+# paths can be given as (path, name in tarball)
+# hard links are stored once in the tarball
+def makeTarball(tarname,paths,threads):
+    paths = [path if isinstance(path,tuple) else (path,path) for path in paths]
+    pigz = None
+    if threads!=1:
+        for path in os.environ.get("PATH","").split(os.pathsep):
+            if os.access(os.path.join(path,"pigz"),os.X_OK):
+                pigz = os.path.join(path,"pigz")
+                break
+    if pigz is None:
+        with tarfile.open(tarname,"w:gz") as tar:
+            for path,arcname in paths:
+                tar.add(path,arcname)
+        return
+    with open(tarname,'wb') as tfile:
+        cmd = [pigz,"-c"]+(["-p",str(threads)] if threads>0 else [])
+        proc = subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=tfile)
+        with tarfile.open(fileobj=proc.stdin,mode="w|") as tar:
+            for path,arcname in paths:
+                tar.add(path,arcname)
+        proc.stdin.close()
+        if proc.wait()!=0:
+            raise RuntimeError("pigz failed to compress "+tarname)
+
+# process numbers from a Queue statement, if it specifies them ("Queue N" or "Queue Process in ...")
+def queueProcs(queue):
+    words = queue.replace(","," ").split()
+    if len(words)==2 and words[1].isdigit():
+        return list(six.moves.range(int(words[1])))
+    if len(words)>3 and words[1]=="Process" and words[2].lower()=="in":
+        return [int(word) for word in words[3:] if word.strip("()").isdigit()]
+    return []
+
+def createChain(jdls,name,log,checkpoint,threads=0,timing=False):
     final = DefaultOrderedDict(str)
     queue = ""
     if not os.path.isdir(name): os.mkdir(name)
     key_transfer = "transfer_input_files"
     job_counter = 0
+    store = inputStore()
+    proc_files = defaultdict(list)
     for jdl in jdls:
         jname = os.path.basename(jdl).replace(".jdl","")
         jdir = os.path.dirname(jdl)
@@ -87,13 +168,15 @@ def createChain(jdls,name,log,checkpoint):
                 for file in val.split(','):
                     file = file.strip()
                     if len(file)==0: continue
-                    # todo: find better way to handle "one input file per job" case
+                    # "one input file per job" case: put each file in a separate tarball for its process
                     if "$(Process)" in file:
-                        files = glob.glob(file.replace("$(Process)","*"))
+                        pattern = re.compile(re.escape(os.path.join(jdir,file)).replace(re.escape("$(Process)"),"([0-9]+)")+"$")
+                        for pfile in glob.glob(os.path.join(jdir,file.replace("$(Process)","*"))):
+                            pmatch = pattern.match(pfile)
+                            if pmatch is None: continue
+                            proc_files[int(pmatch.group(1))].append((pfile,os.path.join(name,subdir,os.path.basename(pfile))))
                     else:
-                        files = [file]
-                    for file in files:
-                        shutil.copy2(os.path.join(jdir,file),subdir_path)
+                        store.add(os.path.join(jdir,file),subdir_path)
             # keep each job's arguments separate
             elif key=="arguments":
                 argfile = os.path.join(subdir_path,"arguments.txt")
@@ -117,24 +200,44 @@ def createChain(jdls,name,log,checkpoint):
         job_counter += 1
     # make combined tarball of all job input files
     tarname = "{}.tar.gz".format(name)
-    with tarfile.open(tarname,"w:gz") as tar:
-        tar.add(name,name)
+    makeTarball(tarname,[name],threads)
+    if store.nlinked>0:
+        print("Deduplicated {} input file(s), saved {} bytes".format(store.nlinked,store.saved))
+    # make one tarball per process for per-process input files
+    # (every process needs one, even if empty, since it is in the transfer_input_files)
+    if len(proc_files)>0:
+        procs = set(six.moves.range(max(proc_files)+1)) | set(queueProcs(queue))
+        for proc in sorted(procs):
+            makeTarball("{}_{}.tar.gz".format(name,proc),proc_files.get(proc,[]),threads)
     # finish up arguments
     final[key_transfer] = "jobExecCondorChain.sh,"+tarname
+    if len(proc_files)>0:
+        final[key_transfer] += ",{}_$(Process).tar.gz".format(name)
     final["arguments"] = "-J {} -N {} -P $(Process)".format(name,job_counter)
     final["executable"] = "jobExecCondorChain.sh"
-    # checkpoint info is kept using condor file transfer
+    # checkpoint info and timing reports are kept using condor file transfer
+    outputs = OrderedDict()
     if checkpoint:
         checkpoint_dir = "checkpoints_{}".format(name)
         checkpoint_fname1 = "checkpoint_{}_$(Process).txt".format(name)
         checkpoint_fname2 = "{}/{}".format(checkpoint_dir,checkpoint_fname1)
-        final["should_transfer_files"] = "YES"
-        final["transfer_output_files"] = checkpoint_fname1
-        final["transfer_output_remaps"] = '"{} = {}"'.format(checkpoint_fname1,checkpoint_fname2)
+        outputs[checkpoint_fname1] = checkpoint_fname2
         # transfer whole dir to avoid having to make empty checkpoint files
         final[key_transfer] = ','.join([final[key_transfer],checkpoint_dir])
         if not os.path.isdir(checkpoint_dir): os.makedirs(checkpoint_dir)
         final["arguments"] += " -C"
+    # one report per process, summarized by chainReport.py
+    if timing:
+        timing_dir = "timing_{}".format(name)
+        timing_fname1 = "timing_{}_$(Process).json".format(name)
+        timing_fname2 = "{}/{}".format(timing_dir,timing_fname1)
+        outputs[timing_fname1] = timing_fname2
+        if not os.path.isdir(timing_dir): os.makedirs(timing_dir)
+        final["arguments"] += " -T"
+    if len(outputs)>0:
+        final["should_transfer_files"] = "YES"
+        final["transfer_output_files"] = ','.join(outputs)
+        final["transfer_output_remaps"] = '"{}"'.format('; '.join("{} = {}".format(key,val) for key,val in six.iteritems(outputs)))
     # write final jdl file
     finalname = "jobExecCondor_{}.jdl".format(name)
     with open(finalname,'w') as ffile:
@@ -147,6 +250,8 @@ if __name__=="__main__":
     parser.add_argument("-j", "--jdls", dest="jdls", type=str, default=[], nargs='+', help="full paths to JDL files")
     parser.add_argument("-l", "--log", dest="log", type=str, required=True, help="log name prefix from first job (will be replaced w/ chain job name)")
     parser.add_argument("-c", "--checkpoint", dest="checkpoint", default=False, action="store_true", help="enable checkpointing (if a job fails, save output files from previous job in chain)")
+    parser.add_argument("-t", "--threads", dest="threads", type=int, default=0, help="number of threads to compress tarball with pigz (if available), 0 for all cores, 1 to disable pigz")
+    parser.add_argument("-T", "--timing", dest="timing", default=False, action="store_true", help="return a JSON report of wall time, exit code, and bytes staged for each step (summarize with chainReport.py)")
     args = parser.parse_args()
-    createChain(args.jdls,args.name,args.log,args.checkpoint)
+    createChain(args.jdls,args.name,args.log,args.checkpoint,args.threads,args.timing)
 
@@ -0,0 +1,229 @@
+from __future__ import print_function
+import os, errno, subprocess, threading, itertools, time, six
+from six.moves import queue
+from datetime import datetime
+from Condor.Production.concurrentTasks import run_tasks
+
+# necessary to communicate w/ cmslpc at fnal
+xrd_env = {'XrdSecGSISRVNAMES': 'cmseos.fnal.gov'}
+
+def date_convert(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+def split_pfn(pfn):
+    if "://" in pfn:
+        psplit = pfn.find("/store")
+        lfn = pfn[psplit:]
+        xrd = pfn[:psplit]
+    else:
+        lfn = pfn
+        xrd = ""
+    return xrd, lfn
+
+# convert datetime (or number) to seconds since epoch (local time, as in listings)
+def to_epoch(date):
+    if date is None or isinstance(date,(int,float)): return date
+    return int(time.mktime(date.timetuple()))
+
+# convert "YYYY-MM-DD HH:MM:SS" to seconds since epoch, parsing each hour only once
+class epochParser(object):
+    def __init__(self):
+        self.hours = {}
+
+    def __call__(self, value):
+        hour = value[:13]
+        if hour not in self.hours:
+            self.hours[hour] = to_epoch(date_convert(hour+":00:00"))
+        return self.hours[hour] + int(value[14:16])*60 + int(value[17:19])
+
+# each backend lists a directory as a generator of records: (path, mtime, size)
+# path includes the directory (for consistency with xrdfs ls, which includes the full lfn path /store/...)
+# mtime (seconds since epoch) and size are only filled if dates=True
+
+# run a command and yield its output lines as they are written
+def run_ls_cmd(cmd, env=None):
+    popen_args = dict(
+        stdout=subprocess.PIPE,
+        stderr=open(os.devnull,'w'),
+    )
+    if env is not None:
+        popen_args.update(dict(env=dict(os.environ,**env)))
+    if six.PY3:
+        popen_args.update(dict(encoding="utf-8"))
+    proc = subprocess.Popen(cmd, **popen_args)
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            line = line.rstrip('\n')
+            if len(line)>0: yield line
+    finally:
+        proc.stdout.close()
+        popen_args["stderr"].close()
+        if proc.poll() is None: proc.kill()
+        proc.wait()
+
+class xrdfsLister(object):
+    def ls(self, redir, indir, dates=False):
+        cmd = ["xrdfs",redir,"ls"]+(["-l"] if dates else [])+[indir]
+        parser = epochParser()
+        for line in run_ls_cmd(cmd, xrd_env):
+            if dates:
+                # format: flags date time size path
+                fields = line.split(None,4)
+                yield fields[-1], parser(fields[1]+' '+fields[2][:8]), int(fields[3])
+            else:
+                yield line, None, None
+
+class gfalLister(object):
+    def ls(self, redir, indir, dates=False):
+        if dates:
+            raise ValueError("Date selection not supported for {}".format(redir))
+        for line in run_ls_cmd(["gfal-ls",redir+indir]):
+            yield indir+'/'+line, None, None
+
+# XRootD python bindings: one connection per redirector, reused for all listings
+# the bindings use the environment of the process (xrd_env is not applied),
+# so if a listing fails without it, the xrdfs fallback (which gets xrd_env) is used
+class xrootdLister(object):
+    def __init__(self):
+        from XRootD import client
+        from XRootD.client.flags import DirListFlags
+        self.client = client
+        self.flags = DirListFlags
+        self.filesystems = {}
+        self.lock = threading.Lock()
+
+    def getFileSystem(self, redir):
+        with self.lock:
+            if redir not in self.filesystems:
+                self.filesystems[redir] = self.client.FileSystem(redir)
+            return self.filesystems[redir]
+
+    def ls(self, redir, indir, dates=False):
+        status, listing = self.getFileSystem(redir).dirlist(indir, self.flags.STAT if dates else self.flags.NONE)
+        if not status.ok:
+            raise IOError("Could not list {}{}: {}".format(redir,indir,status.message))
+        prefix = indir.rstrip('/')+'/'
+        for entry in listing:
+            if dates: yield prefix+entry.name, entry.statinfo.modtime, entry.statinfo.size
+            else: yield prefix+entry.name, None, None
+
+# local filesystem (also usable as a stand-in for remote storage, by providing a local directory in place of the redirector)
+class localLister(object):
+    def __init__(self, root=""):
+        self.root = root
+
+    def ls(self, redir, indir, dates=False):
+        localdir = self.root+indir
+        prefix = indir.rstrip('/')+'/' if len(indir)>0 else ""
+        try:
+            if hasattr(os,"scandir"):
+                entries = ((entry.name, entry.stat if dates else None) for entry in os.scandir(localdir if len(localdir)>0 else "."))
+            else:
+                entries = ((name, (lambda name=name: os.stat(os.path.join(localdir,name))) if dates else None) for name in os.listdir(localdir))
+        except OSError as e:
+            # output dir not created yet: no files
+            if e.errno==errno.ENOENT: return
+            raise
+        for name, getstat in entries:
+            if dates:
+                st = getstat()
+                yield prefix+name, int(st.st_mtime), st.st_size
+            else:
+                yield prefix+name, None, None
+
+# backend for each protocol, tried in order (later entries are fallbacks)
+backends = {
+    "root://": [xrootdLister, xrdfsLister],
+    "gsiftp://": [gfalLister],
+    "": [localLister],
+}
+backend_cache = {}
+backend_lock = threading.Lock()
+
+# replace the backends for a protocol, e.g. set_backend("root://", localLister("/tmp/eos"))
+def set_backend(protocol, *listers):
+    with backend_lock:
+        backends[protocol] = list(listers)
+        backend_cache.pop(protocol,None)
+
+# instantiated backends, skipping any that are unavailable (e.g. missing bindings)
+def get_listers(protocol):
+    with backend_lock:
+        if protocol not in backend_cache:
+            listers = []
+            for backend in backends[protocol]:
+                if not isinstance(backend,type):
+                    listers.append(backend)
+                    continue
+                try:
+                    listers.append(backend())
+                except ImportError:
+                    pass
+            backend_cache[protocol] = listers
+        return backend_cache[protocol]
+
+def get_protocol(redir, indir):
+    if indir.startswith("/store/"):
+        for protocol in ["root://","gsiftp://"]:
+            if redir.startswith(protocol): return protocol
+        raise ValueError("Unknown redir {}".format(redir))
+    return ""
+
+# list one directory, with optional date range (datetime or seconds since epoch)
+# yields records lazily: the listing is never held in memory
+def ls_records(redir, indir, minDate=None, maxDate=None):
+    # automatically split
+    if len(indir)==0:
+        redir, indir = split_pfn(redir)
+    minDate = to_epoch(minDate)
+    maxDate = to_epoch(maxDate)
+    checkDates = minDate is not None or maxDate is not None
+
+    listers = get_listers(get_protocol(redir, indir))
+    for ilister,lister in enumerate(listers):
+        records = lister.ls(redir, indir, checkDates)
+        # backends fail on the first record (if at all), so the next backend can still be tried
+        try:
+            first = next(records, None)
+            break
+        except (IOError,OSError):
+            if ilister==len(listers)-1: raise
+    if first is None: return
+
+    for record in itertools.chain([first],records):
+        if checkDates and ((minDate is not None and record[1]<=minDate) or (maxDate is not None and record[1]>=maxDate)): continue
+        yield record
+
+# list several directories concurrently: yields records from all dirs as they arrive
+def ls_many(dirs, minDate=None, maxDate=None, nthreads=4, chunksize=1000):
+    dirs = list(dirs)
+    if len(dirs)<=1 or nthreads<=1:
+        for indir in dirs:
+            for record in ls_records(indir, "", minDate, maxDate):
+                yield record
+        return
+
+    # bounded, so a slow consumer does not accumulate the listings in memory
+    chunks = queue.Queue(maxsize=4*nthreads)
+    def lister(indir):
+        chunk = []
+        for record in ls_records(indir, "", minDate, maxDate):
+            chunk.append(record)
+            if len(chunk)>=chunksize:
+                chunks.put(chunk)
+                chunk = []
+        if len(chunk)>0: chunks.put(chunk)
+    def collect():
+        for indir, result, error in run_tasks(lister, dirs, nthreads):
+            if error is not None: chunks.put(error)
+        chunks.put(None)
+    thread = threading.Thread(target=collect)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        chunk = chunks.get()
+        if chunk is None: break
+        if isinstance(chunk,Exception): raise chunk
+        for record in chunk:
+            yield record
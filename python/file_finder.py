@@ -2,7 +2,12 @@ from __future__ import print_function
 import os
 import subprocess
 import sys
+import json
+import mmap
+import multiprocessing
+import time
 import six
+from concurrentTasks import run_tasks
 
 def fprint(msg, newline=True):
     import sys
@@ -20,40 +25,131 @@ def find_nth(haystack, needle, n):
         n -= 1
     return start
 
-def find_site(file_per_job, preferred_sites = None, prefer_us_sites = False, blacklisted_sites = None, verbose = False):
+# default DAS client: returns the list of sites for a file, or [None] if the query failed
+def dasgoclient_sites(file):
+    cmd = ["dasgoclient", "-query=site file=" + file]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    out, err = p.communicate()
+    return [None] if "WARNING:" in out or p.returncode != 0 else out.split()
+
+# on-disk cache of DAS answers: {file: [time, sites]}
+def load_site_cache(cache_file, ttl):
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except ValueError:
+        return {}
+    now = time.time()
+    return {file: entry for file, entry in six.iteritems(cache) if now - entry[0] < ttl*3600}
+
+def save_site_cache(cache_file, cache):
+    if not cache_file:
+        return
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp_file, cache_file)
+
+def find_site(file_per_job, preferred_sites = None, prefer_us_sites = False, blacklisted_sites = None, verbose = False,
+              nthreads = 8, das_cache = "", das_ttl = 24, das_client = None):
+    if das_client is None:
+        das_client = dasgoclient_sites
     file_and_site_per_job = {}
     if verbose:
         fprint("Finding the sites for each file ...", True)
-    for i, (job, file) in enumerate(six.iteritems(file_per_job)):
+
+    # look up each file only once, and only if not in the cache
+    cache = load_site_cache(das_cache, das_ttl)
+    files = set(file for file in six.itervalues(file_per_job) if file is not None)
+    lookups = sorted(file for file in files if file not in cache)
+    if verbose:
+        fprint("\t" + str(len(files)) + " unique file(s), " + str(len(files) - len(lookups)) + " found in cache", True)
+    sites_per_file = {file: cache[file][1] for file in files if file in cache}
+    for file, sites, error in run_tasks(das_client, lookups, nthreads):
+        if verbose:
+            fprint("\tdasgoclient -query=\"site file=" + file + "\"", True)
+        if error is not None:
+            sites = [None]
+        sites_per_file[file] = sites
+        # failed queries are not cached
+        if sites != [None]:
+            cache[file] = [time.time(), sites]
+    if len(lookups) > 0:
+        save_site_cache(das_cache, cache)
+
+    for job, file in six.iteritems(file_per_job):
         if file is None:
             file_and_site_per_job[job] = (file,None,[None])
         else:
-            cmd = "dasgoclient -query=\"site file=" + file + "\""
-            if verbose:
-                fprint("\t" + cmd, True)
-            p = subprocess.Popen(cmd, shell = True, stdout=subprocess.PIPE)
-            out, err = p.communicate()
-            sites = [None] if "WARNING:" in out else out.split()
+            sites = sites_per_file[file]
             site = select_site(sites, preferred_sites, prefer_us_sites, blacklisted_sites)
             file_and_site_per_job[job] = (file,site,sites)
     return file_and_site_per_job
 
-def get_input_file(basepath, jobs, key, verbose = False):
+# extract the first input file (LFN) from a line or list of files
+def parse_input_file(text):
+    text = text[text.find("/store/"):]
+    text = text.split(",")[0]
+    if ".root" in text:
+        text = text[:text.rfind(".root")+5]
+    if "/store/test/xrootd/" in text:
+        text = text[find_nth(text,"/store/",2):]
+    return text
+
+# find the last line containing key, searching backwards from the end of the file (without reading the whole file)
+def find_last_line(fname, key):
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = mm.rfind(key)
+            if pos < 0:
+                return None
+            start = mm.rfind(b"\n", 0, pos) + 1
+            end = mm.find(b"\n", pos)
+            if end < 0:
+                end = len(mm)
+            return mm[start:end].decode("utf-8", "replace")
+        finally:
+            mm.close()
+
+# returns the input file from a log, or None if the key is not found
+def scan_log(args):
+    fname, key = args
+    line = find_last_line(fname, key)
+    return parse_input_file(line) if line is not None else None
+
+def get_input_file(basepath, jobs, key, verbose = False, nprocs = 4):
     file_per_job = {}
     if verbose:
         fprint("Finding the input file for each job ...", False)
+    logs = []
     for job in jobs:
         output_file = basepath+job.stdout+".stdout"
         if not os.path.exists(output_file):
             file_per_job[job] = None
         else:
-            with open(output_file, 'r') as f:
-                for line in lines_that_contain(key, f):
-                    line = line[line.find("/store/"):line.rfind(".root")+5]
-                    line = line.split(",")[0]
-                    if "/store/test/xrootd/" in line:
-                        line = line[find_nth(line,"/store/",2):]
-                    file_per_job[job] = line
+            logs.append((job, output_file))
+    # scan several logs at once
+    tasks = [(output_file, key) for job, output_file in logs]
+    if nprocs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(nprocs, len(tasks)))
+        try:
+            results = pool.map(scan_log, tasks, chunksize=max(1, len(tasks)//(4*nprocs)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [scan_log(task) for task in tasks]
+    for (job, output_file), input_file in zip(logs, results):
+        # jobs whose logs do not contain the key are omitted
+        if input_file is not None:
+            file_per_job[job] = input_file
     if verbose:
         fprint("DONE")
     return file_per_job
@@ -64,20 +160,13 @@ def get_input_file_from_classad(jobs, classad, verbose = False):
         fprint("Finding the input file for each job ...", False)
     for job in jobs:
         if hasattr(job, "inputFiles"):
-            input_file = job.inputFiles.split(",")[0]
-            input_file = input_file[input_file.find("/store/"):input_file.rfind(".root")+5]
-            if "/store/test/xrootd/" in input_file:
-                input_file = input_file[find_nth(input_file,"/store/",2):]
-            file_per_job[job] = input_file
+            file_per_job[job] = parse_input_file(job.inputFiles)
         else:
             file_per_job[job] = None
     if verbose:
         fprint("DONE")
     return file_per_job        
 
-def lines_that_contain(string, fp):
-    return [line for line in fp if string in line]
-
 def select_site(sites, preferred_sites = None, prefer_us_sites = False, blacklisted_sites = None):
     selected = None
     sites = [s.replace("_Disk","") for s in sites if s is not None and "Tape" not in s]
@@ -98,7 +187,11 @@ def find_input_file_site_per_job(blacklisted_sites = None,
                                  log_path = "",
                                  preferred_sites = None,
                                  prefer_us_sites = False,
-                                 verbose = False):
+                                 verbose = False,
+                                 nthreads = 8,
+                                 das_cache = "",
+                                 das_ttl = 24,
+                                 das_client = None):
     if condor_jobs is None:
         return
 
@@ -112,12 +205,12 @@ def find_input_file_site_per_job(blacklisted_sites = None,
     if classad:
         file_per_job = get_input_file_from_classad(condor_jobs, classad, verbose)
     elif log_path:
-        file_per_job = get_input_file(log_path, condor_jobs, log_key, verbose)
+        file_per_job = get_input_file(log_path, condor_jobs, log_key, verbose, nthreads)
     else:
         fprint("file_finder.py: error: You must select a method to obtain the input file information (--classad and/or --log_path/--log_key).")
         sys.exit(2)
     
-    file_and_site_per_file = find_site(file_per_job, preferred_sites, prefer_us_sites, blacklisted_sites, verbose)
+    file_and_site_per_file = find_site(file_per_job, preferred_sites, prefer_us_sites, blacklisted_sites, verbose, nthreads, das_cache, das_ttl, das_client)
 
     return file_and_site_per_file
 
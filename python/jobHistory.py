@@ -0,0 +1,107 @@
+import sqlite3, time
+from collections import OrderedDict, defaultdict
+
+# minimum time without progress (in seconds) before a job can be considered stuck (progress is only reported periodically)
+minStall = 3600
+
+# time series of the progress of running jobs, shared between runs of manageJobs
+# a sample is only stored when the number of events changes, so each sample marks the (first observed) time of some progress
+class jobHistory(object):
+    def __init__(self,fname,window=6,keep=7):
+        self.fname = fname
+        self.window = window*3600
+        self.keep = keep*86400
+        self.conn = sqlite3.connect(fname)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (job TEXT PRIMARY KEY, name TEXT, first INTEGER, seen INTEGER, events INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS samples (job TEXT, time INTEGER, events INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS samples_job ON samples (job, time)")
+        self.conn.commit()
+
+    # record the current progress of running jobs
+    def add(self,jobs):
+        running = [j for j in jobs if j.status==2]
+        # schedd time, if available (consistent with sample times)
+        now = max([j.servertime for j in running]+[0]) or int(time.time())
+        last = self.getLast(j.stdout for j in running)
+        samples = []
+        for j in running:
+            jtime = j.servertime if j.servertime>0 else now
+            if j.stdout not in last or last[j.stdout]!=j.events:
+                samples.append((j.stdout,jtime,j.events))
+            # update keeps the time when the job was first observed
+            self.conn.execute("INSERT OR IGNORE INTO jobs (job,name,first,seen,events) VALUES (?,?,?,?,?)",(j.stdout,j.name,jtime,jtime,j.events))
+            self.conn.execute("UPDATE jobs SET seen=?, events=? WHERE job=?",(jtime,j.events,j.stdout))
+        self.conn.executemany("INSERT INTO samples (job,time,events) VALUES (?,?,?)",samples)
+        self.prune(now)
+
+    def getLast(self,names):
+        names = set(names)
+        return {row[0]: row[1] for row in self.conn.execute("SELECT job, events FROM jobs") if row[0] in names}
+
+    # remove jobs not seen recently, and old samples (except the latest one for each job)
+    def prune(self,now):
+        cutoff = now-self.keep
+        self.conn.execute("DELETE FROM samples WHERE job IN (SELECT job FROM jobs WHERE seen<?)",(cutoff,))
+        self.conn.execute("DELETE FROM jobs WHERE seen<?",(cutoff,))
+        self.conn.execute("DELETE FROM samples WHERE time<? AND rowid NOT IN (SELECT MAX(rowid) FROM samples GROUP BY job)",(cutoff,))
+
+    # samples since the job last (re)started, i.e. since the number of events last decreased
+    def getSeries(self,names):
+        names = set(names)
+        series = defaultdict(list)
+        for job, stime, events in self.conn.execute("SELECT job, time, events FROM samples ORDER BY job, time, rowid"):
+            if job not in names: continue
+            if len(series[job])>0 and events<series[job][-1][1]: series[job] = []
+            series[job].append((stime,events))
+        return series
+
+    # compute recent rate (evt/sec over the window), ETA (hours), and time without progress (seconds) for running jobs
+    def evaluate(self,jobs):
+        running = [j for j in jobs if j.status==2]
+        series = self.getSeries(j.stdout for j in running)
+        for j in running:
+            samples = series.get(j.stdout,[])
+            if len(samples)==0: continue
+            now = j.servertime if j.servertime>0 else int(time.time())
+            j.stalled = max(now-samples[-1][0],0)
+            # no progress since the job last reported either (e.g. a job already stalled when first recorded)
+            if j.update>0: j.stalled = max(j.stalled,now-j.update)
+            # number of events at the start of the window
+            start = now-self.window
+            before = [sample for sample in samples if sample[0]<=start]
+            t0, e0 = (start, before[-1][1]) if len(before)>0 else samples[0]
+            j.recent = float(j.events-e0)/(now-t0) if now>t0 else j.rate
+            rate = j.recent if j.recent>0 else j.rate
+            if j.maxevents>0 and rate>0:
+                j.eta = max(j.maxevents-j.events,0)/rate/3600
+
+    # rate-based: stuck if the job would have processed stallEvents at its average rate without any progress
+    # falls back to the time since the last update if there is no rate (or no history)
+    def isStuck(self,j,stallEvents,threshold):
+        if j.stalled is not None and j.rate>0:
+            if j.stalled>=minStall and j.rate*j.stalled>=stallEvents:
+                return "Job stuck for {:.1f} hours (expected {:d} events at {:.2f} evt/sec)".format(j.stalled/3600.,int(j.rate*j.stalled),j.rate)
+            return ""
+        tdiff = j.servertime - j.update
+        if j.servertime>0 and j.update>0 and tdiff>threshold*3600:
+            return "Job stuck for "+str(tdiff/3600)+" hours"
+        return ""
+
+    # throughput and ETA per production (jobs with the same name)
+    def summarize(self,jobs):
+        summary = OrderedDict()
+        for j in sorted([j for j in jobs if j.status==2], key=lambda j: j.name):
+            prod = summary.setdefault(j.name, OrderedDict([("jobs",0),("events",0),("maxevents",0),("rate",0.),("recent",0.),("eta",0.),("unknown",0)]))
+            prod["jobs"] += 1
+            prod["events"] += j.events
+            prod["maxevents"] += max(j.maxevents,0)
+            prod["rate"] += j.rate
+            prod["recent"] += j.recent if j.recent is not None else j.rate
+            # production finishes when its slowest job finishes
+            if j.eta is not None: prod["eta"] = max(prod["eta"],j.eta)
+            else: prod["unknown"] += 1
+        return summary
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,40 @@
+import sqlite3, time
+
+# persistent record of finished jobs (output found) and cleaned jobs (logs archived), shared between runs of missing and clean modes
+# jobs still in the queue are always taken from the schedd, so a finished job that is still queued (or resubmitted) is not forgotten
+class jobLedger(object):
+    def __init__(self,fname):
+        self.fname = fname
+        self.conn = sqlite3.connect(fname)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS finished (name TEXT PRIMARY KEY, cleaned INTEGER, updated INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+    def getMeta(self,key,default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key=?",(key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def setMeta(self,key,value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key,value) VALUES (?,?)",(key,value))
+
+    def setFinished(self,names):
+        now = int(time.time())
+        self.conn.executemany("INSERT OR IGNORE INTO finished (name,cleaned,updated) VALUES (?,0,?)",((name,now) for name in names))
+
+    # replace all finished jobs (jobs with logs already archived are kept)
+    def resetFinished(self,names=()):
+        self.conn.execute("DELETE FROM finished WHERE cleaned=0")
+        self.setFinished(names)
+
+    def setCleaned(self,names):
+        now = int(time.time())
+        self.conn.executemany("INSERT OR REPLACE INTO finished (name,cleaned,updated) VALUES (?,1,?)",((name,now) for name in names))
+
+    # all finished jobs, or only those with logs already archived
+    def getFinished(self,cleaned=False):
+        query = "SELECT name FROM finished"+(" WHERE cleaned=1" if cleaned else "")
+        return set(row[0] for row in self.conn.execute(query))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,110 @@
+import sqlite3, time, json, re
+from collections import OrderedDict
+
+# one rule: jobs whose hold reason (and optionally name) match are released or removed
+# example: {"match": "XRootD|File open", "redirector": "T1_US_FNAL", "rmsites": ["T2_US_MIT"], "maxretries": 3}
+class policyRule(object):
+    actions = ["release","kill"]
+
+    def __init__(self,rule):
+        if "match" not in rule:
+            raise ValueError("Policy rule without match: "+json.dumps(rule))
+        self.match = re.compile(rule["match"])
+        self.name = re.compile(rule["name"]) if "name" in rule else None
+        self.action = rule.get("action","release")
+        if self.action not in self.actions:
+            raise ValueError("Unknown policy action: "+self.action)
+        self.redirector = rule.get("redirector","")
+        if len(self.redirector)>0 and self.redirector[0:7]!="root://" and self.redirector[0]!="T":
+            raise ValueError("Improper xrootd address in policy: "+self.redirector)
+        self.addsites = rule.get("addsites",[])
+        self.rmsites = rule.get("rmsites",[])
+        # remove jobs after this many releases (0 = never)
+        self.maxretries = int(rule.get("maxretries",0))
+
+    def matches(self,job):
+        return self.match.search(job.why) is not None and (self.name is None or self.name.search(job.stdout) is not None)
+
+    def describe(self):
+        desc = ["match = "+self.match.pattern]
+        if len(self.redirector)>0: desc.append("redirector = "+self.redirector)
+        if len(self.addsites)>0: desc.append("add sites = "+",".join(self.addsites))
+        if len(self.rmsites)>0: desc.append("remove sites = "+",".join(self.rmsites))
+        return ", ".join(desc)
+
+# rules from a JSON file (list of rules, first match is used), with retry counters and release rates kept in a database between runs
+class jobPolicy(object):
+    def __init__(self,rulefile,dbfile,rate=60,burst=100,keep=7):
+        with open(rulefile) as rfile:
+            self.rules = [policyRule(rule) for rule in json.load(rfile)]
+        # token bucket for each schedd: rate in releases per minute, up to burst releases at once
+        self.rate = rate/60.
+        self.burst = burst
+        self.keep = keep*86400
+        self.conn = sqlite3.connect(dbfile)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS retries (job TEXT PRIMARY KEY, count INTEGER, updated INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (schedd TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        # forget jobs that have not been released recently
+        self.conn.execute("DELETE FROM retries WHERE updated<?",(int(time.time())-self.keep,))
+        self.conn.commit()
+
+    def getRule(self,job):
+        for rule in self.rules:
+            if rule.matches(job): return rule
+        return None
+
+    @staticmethod
+    def key(schedd,job):
+        return schedd+":"+job.num
+
+    def getRetries(self,schedd,jobs):
+        keys = set(self.key(schedd,j) for j in jobs)
+        return {row[0]: row[1] for row in self.conn.execute("SELECT job, count FROM retries") if row[0] in keys}
+
+    # take up to n tokens from the schedd's bucket, returns number taken
+    def take(self,schedd,n,consume=True):
+        now = time.time()
+        row = self.conn.execute("SELECT tokens, updated FROM buckets WHERE schedd=?",(schedd,)).fetchone()
+        tokens = self.burst if row is None else min(self.burst,row[0]+self.rate*(now-row[1]))
+        taken = min(n,int(tokens))
+        if consume:
+            self.conn.execute("INSERT OR REPLACE INTO buckets (schedd,tokens,updated) VALUES (?,?,?)",(schedd,tokens-taken,now))
+            self.conn.commit()
+        return taken
+
+    # decide what to do with held jobs from one schedd
+    # returns releases (rule -> jobs), kills (list of (job, reason)), deferred (jobs over the release rate, left for the next run)
+    def plan(self,jobs,schedd,consume=True):
+        retries = self.getRetries(schedd,jobs)
+        candidates = []
+        kills = []
+        for j in jobs:
+            rule = self.getRule(j)
+            if rule is None: continue
+            nretries = retries.get(self.key(schedd,j),0)
+            if rule.action=="kill":
+                kills.append((j,"matched "+rule.match.pattern))
+            elif rule.maxretries>0 and nretries>=rule.maxretries:
+                kills.append((j,"released {} times".format(nretries)))
+            else:
+                candidates.append((j,rule))
+        ntaken = self.take(schedd,len(candidates),consume)
+        releases = OrderedDict()
+        for j,rule in candidates[:ntaken]:
+            releases.setdefault(rule,[]).append(j)
+        deferred = [j for j,rule in candidates[ntaken:]]
+        return releases, kills, deferred
+
+    def record(self,schedd,jobs):
+        now = int(time.time())
+        retries = self.getRetries(schedd,jobs)
+        self.conn.executemany("INSERT OR REPLACE INTO retries (job,count,updated) VALUES (?,?,?)",((self.key(schedd,j),retries.get(self.key(schedd,j),0)+1,now) for j in jobs))
+        self.conn.commit()
+
+    def forget(self,schedd,jobs):
+        self.conn.executemany("DELETE FROM retries WHERE job=?",((self.key(schedd,j),) for j in jobs))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
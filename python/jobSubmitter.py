@@ -1,12 +1,12 @@
 from __future__ import print_function
-import os, subprocess, sys, stat, glob, shutil, tarfile, six
+import os, subprocess, sys, stat, glob, shutil, hashlib, json, six
 from optparse import OptionParser
 from collections import defaultdict, OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
 from Condor.Production.parseConfig import list_callback, parser_dict
-
-def date_convert(value):
-    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+from Condor.Production.concurrentTasks import run_tasks, TaskTimeout
+from Condor.Production.jobLedger import jobLedger
+from Condor.Production.dirListing import date_convert, split_pfn, ls_records, ls_many, xrd_env
 
 def date_callback(option, opt, value, parser):
     if value is None: return
@@ -23,72 +23,115 @@ def pysed(lines,out,patterns):
                 linetmp = linetmp.replace(str(pattern),str(replace))
             outfile.write(linetmp)
 
+# JDL template compiled once for repeated find/replace (same results as pysed)
+# each set of pattern keys is split into literal text and placeholders only once;
+# values are then filled in a single pass, unless a value could interact with a later pattern
+class jdlTemplate(object):
+    def __init__(self,lines):
+        self.lines = list(lines)
+        self.plans = {}
+        self.overlaps = {}
+
+    # list of literal strings and pattern indices
+    # patterns with empty replacements are applied directly, as their effect depends on the surrounding text
+    def compile(self,keys,empty):
+        plan = []
+        for line in self.lines:
+            parts = [line]
+            for ikey,key in enumerate(keys):
+                newparts = []
+                for part in parts:
+                    if not isinstance(part,six.string_types):
+                        newparts.append(part)
+                    elif ikey in empty:
+                        newparts.append(part.replace(key,""))
+                    else:
+                        pieces = part.split(key)
+                        newparts.append(pieces[0])
+                        for piece in pieces[1:]:
+                            newparts.extend([ikey,piece])
+                parts = newparts
+            for part in parts:
+                if not isinstance(part,six.string_types): plan.append(part)
+                elif len(part)==0: continue
+                elif len(plan)>0 and isinstance(plan[-1],six.string_types): plan[-1] += part
+                else: plan.append(part)
+        return plan
+
+    # check if a later pattern could match any text that overlaps this value
+    def overlap(self,value,key):
+        if (value,key) not in self.overlaps:
+            result = key in value or value in key
+            for i in range(1,min(len(key),len(value))):
+                if result: break
+                result = value.endswith(key[:i]) or value.startswith(key[-i:])
+            self.overlaps[(value,key)] = result
+        return self.overlaps[(value,key)]
+
+    def render(self,patterns):
+        keys = []
+        values = []
+        for pattern,replace in six.iteritems(patterns):
+            keys.append(str(pattern))
+            values.append(str(replace))
+        single = all(len(key)>0 for key in keys) and not any(
+            len(value)>0 and any(self.overlap(value,key) for key in keys[ivalue+1:]) for ivalue,value in enumerate(values)
+        )
+        if not single:
+            # ordered replacement, line by line
+            result = []
+            for line in self.lines:
+                for key,value in zip(keys,values):
+                    line = line.replace(key,value)
+                result.append(line)
+            return "".join(result)
+        empty = frozenset(ivalue for ivalue,value in enumerate(values) if len(value)==0)
+        plankey = (tuple(keys),empty)
+        if plankey not in self.plans:
+            self.plans[plankey] = self.compile(keys,empty)
+        return "".join([part if isinstance(part,six.string_types) else values[part] for part in self.plans[plankey]])
+
+# template used by write_jdl (set per process, to avoid sending it with every job)
+prepare_template = None
+def init_prepare(template):
+    global prepare_template
+    prepare_template = template
+
+# write one JDL file atomically: entry = (jdl, [(pattern, replacement)], text appended after template)
+def write_jdl(entry):
+    jdl, patterns, tail = entry
+    tmpname = jdl+".tmp"
+    with open(tmpname,'w') as outfile:
+        outfile.write(prepare_template.render(OrderedDict(patterns)))
+        outfile.write(tail)
+    os.rename(tmpname,jdl)
+    st = os.stat(jdl)
+    return jdl, st.st_mtime, st.st_size
+
+# avoid rewriting files (and changing their timestamps) if the contents are the same
+def write_if_changed(fname,contents):
+    if os.path.isfile(fname):
+        with open(fname,'r') as file:
+            if file.read()==contents: return False
+    with open(fname,'w') as file:
+        file.write(contents)
+    return True
+
 # run xrdfs ls using physical file name
 def generalized_ls(redir, indir, minDate=None, maxDate=None):
-    checkDates = minDate is not None or maxDate is not None
-    extra = " -l --full-time" if checkDates else ""
-
-    # automatically split
-    if len(indir)==0:
-        redir, indir = split_pfn(redir)
-
-    cmd = None
-    if indir.startswith("/store/"):
-        if redir.startswith("root://"):
-            date_split_start = 1
-            cmd = "xrdfs {} ls {} {}".format(redir,extra.replace("--full-time",""),indir)
-        elif redir.startswith("gsiftp://"):
-            date_split_start = 5
-            cmd = "gfal-ls {}".format(redir+indir)
-        else:
-            raise ValueError("Unknown redir {}".format(redir))
-    else:
-        date_split_start = 5
-        cmd = "ls {} {}".format(extra,indir)
-
-    # todo: replace w/ XRootD python bindings?
-    popen_args = dict(
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    if cmd.startswith("xrdfs"):
-        # necessary to communicate w/ cmslpc at fnal
-        popen_args.update(dict(env=dict(os.environ,**{'XrdSecGSISRVNAMES': 'cmseos.fnal.gov'})))
-    if six.PY3:
-        popen_args.update(dict(encoding="utf-8"))
-    results = list(filter(
-        None,
-        subprocess.Popen(
-            cmd,
-            **popen_args
-        ).communicate()[0].split('\n')
-    ))
-
-    # for consistency with xrdfs ls, which includes full lfn path (/store/...) in output
-    if not cmd.startswith("xrdfs"):
-        results = [lfn+'/'+res for res in results]
-
-    if checkDates:
-        dates = [date_convert(' '.join(line.split()[date_split_start:date_split_start+2])) for line in results]
-        results = [line.split()[-1] for line,date in zip(results,dates) if (minDate is None or date>minDate) and (maxDate is None or date<maxDate)]
-
-    return results
-
-def split_pfn(pfn):
-    if "://" in pfn:
-        psplit = pfn.find("/store")
-        lfn = pfn[psplit:]
-        xrd = pfn[:psplit]
-    else:
-        lfn = pfn
-        xrd = ""
-    return xrd, lfn
+    return [record[0] for record in ls_records(redir, indir, minDate, maxDate)]
 
 # backward compatibility
 def pyxrdfsls(pfn, minDate=None, maxDate=None):
     return generalized_ls(pfn, "", minDate, maxDate)
 
+# find an executable in the path
+def find_exe(name):
+    for path in os.environ.get("PATH","").split(os.pathsep):
+        exe = os.path.join(path,name)
+        if os.path.isfile(exe) and os.access(exe,os.X_OK): return exe
+    return None
+
 # run xrdcp
 def pyxrdcp(a,b,verbose=True):
     # xrootd dir
@@ -114,12 +157,116 @@ def match(pattern,fname):
             return result.group(1)
     return None
 
+def get_condor():
+    # try to find condor bindings
+    if six.PY2:
+        for condorPath in glob.glob("/usr/lib64/python{}.*/site-packages".format(sys.version_info[0])):
+            if condorPath not in sys.path and os.path.isdir(condorPath):
+                sys.path.append(condorPath)
+    # try to import condor bindings
+    try:
+        global htcondor,classad
+        import htcondor,classad
+    except:
+        print('Could not import htcondor bindings!')
+        return False
+    return True
+
+# convert a queue statement ("-queue ..." or "Queue ...") into (count, itemdata) for the htcondor bindings
+def parse_queue(queue):
+    args = queue.strip()
+    if args.startswith("-"): args = args[1:]
+    if args.lower().startswith("queue"): args = args[5:]
+    args = args.strip().strip('"').strip()
+    if len(args)==0: return 1, None
+    if args.isdigit(): return int(args), None
+    words = args.split(None,2)
+    if len(words)==3 and words[1].lower() in ["in","from"]:
+        if words[1].lower()=="in":
+            items = words[2].strip().lstrip("(").rstrip(")").replace(","," ").split()
+        else:
+            with open(words[2].strip(),'r') as itemfile:
+                items = [line.strip() for line in itemfile if len(line.strip())>0]
+        return 1, [{words[0]: item} for item in items]
+    raise ValueError("Unsupported queue statement: "+queue)
+
+# read a prepared JDL into a Submit object (without its Queue statement), with (count, itemdata) from the queue
+# if queue is None, the Queue statement from the JDL is used
+def read_submit(jdl, queue=None):
+    import re
+    queue_re = re.compile(r"^\s*queue(\s|$)", re.IGNORECASE)
+    lines = []
+    with open(jdl,'r') as jfile:
+        for line in jfile:
+            if queue_re.match(line):
+                if queue is None: queue = line
+            else:
+                lines.append(line)
+    if queue is None: queue = "Queue"
+    count, itemdata = parse_queue(queue)
+    return htcondor.Submit("".join(lines)), count, itemdata
+
+# raised if submission fails after some JDLs were already submitted
+class BulkSubmitError(Exception):
+    def __init__(self, error, results):
+        super(BulkSubmitError,self).__init__(str(error))
+        # [(jdl, clusterId, number of jobs)] for the entries submitted before the failure (in order)
+        self.results = results
+
+# submit several prepared JDLs to one schedd
+# entries = [(jdl, queue)]; if queue is None, the Queue statement from the JDL is used
+# returns [(jdl, clusterId, number of jobs)]
+def submit_bulk(entries, schedd=None):
+    if schedd is None: schedd = htcondor.Schedd()
+    subs = [(jdl,)+read_submit(jdl,queue) for jdl, queue in entries]
+    results = []
+    # current bindings: Schedd.submit() with itemdata
+    for jdl, sub, count, itemdata in subs:
+        try:
+            if itemdata is None: result = schedd.submit(sub, count=count)
+            else: result = schedd.submit(sub, count=count, itemdata=iter(itemdata))
+        except Exception as e:
+            # older bindings, where submit() only takes a ClassAd
+            if isinstance(e,TypeError) and len(results)==0: break
+            raise BulkSubmitError(e, results)
+        results.append((jdl, result.cluster(), result.num_procs()))
+    else:
+        return results
+    # fallback: one transaction for all JDLs (if it fails, nothing is submitted)
+    with schedd.transaction() as txn:
+        for jdl, sub, count, itemdata in subs:
+            if itemdata is None: result = sub.queue_with_itemdata(txn, count)
+            else: result = sub.queue_with_itemdata(txn, count, iter(itemdata))
+            results.append((jdl, result.cluster(), result.num_procs()))
+    return results
+
+# submit using the bindings (if bulk), and condor_submit for any JDLs that could not be submitted that way
+def submit_entries(entries, bulk=True):
+    remaining = entries
+    if bulk:
+        try:
+            results = submit_bulk(entries)
+            error = None
+        except Exception as e:
+            results = getattr(e,"results",[])
+            error = e
+        for jdl, cluster, nprocs in results:
+            print(str(nprocs)+" job(s) submitted to cluster "+str(cluster)+" from "+jdl)
+        remaining = entries[len(results):]
+        if error is not None:
+            print("Bulk submission failed ("+str(error)+"), using condor_submit instead"+(" for the remaining JDLs" if len(results)>0 else ""))
+    for jdl, queue in remaining:
+        cmd = "condor_submit "+jdl
+        if queue is not None: cmd += " "+queue
+        os.system(cmd)
+
 class protoJob(object):
     def __init__(self):
         self.patterns = OrderedDict()
         self.appends = []
         self.queue = ""
         self.njobs = 0
+        # any sequence of job numbers: a list, or a compact range(N) or array('i') for large sets
         self.nums = []
         self.jdl = ""
         self.name = "job"
@@ -142,6 +289,23 @@ class protoJob(object):
     def makeName(self,num):
         return self.name+"_"+str(num)
 
+    # kept to check whether makeName has been overridden
+    defaultMakeName = makeName
+
+    # job numbers can be matched directly to parsed job names if the default naming scheme is used
+    def hasDefaultNames(self):
+        return getattr(self.makeName,"__func__",None) is protoJob.__dict__["defaultMakeName"]
+
+# split job names from the default naming scheme into base name and job number
+def index_names(names):
+    index = defaultdict(set)
+    for name in names:
+        base, sep, num = name.rpartition("_")
+        # only canonical numbers (e.g. not 01) can be produced by makeName
+        if len(sep)>0 and num.isdigit() and str(int(num))==num:
+            index[base].add(int(num))
+    return index
+
 class jobSubmitter(object):
     def __init__(self,argv=None,parser=None):
         if argv is None: argv = sys.argv[1:]
@@ -180,6 +344,18 @@ class jobSubmitter(object):
         self.runSet = set()
         self.missingNums = {}
         self.missingLines = []
+        self.resubEntries = []
+        # maximum length of an inline list of job numbers to resubmit
+        self.inlineQueueMax = 1000
+        self.cleanedNames = []
+        self.jobLedger = None
+        self.submitEntries = []
+        self.jdlCompiled = None
+        self.jdlDigest = ""
+        self.manifest = None
+        self.prepareEntries = []
+        self.prepareCounts = [0,0]
+        self.hostInfo = None
 
     def run(self):
         self.initRun()
@@ -187,6 +363,15 @@ class jobSubmitter(object):
         # job generation
         self.generateSubmission()
 
+        # after job generation, so checks can be restricted to these jobs
+        self.initModes()
+
+        # prepare all protojobs first (so other modes can use the JDLs)
+        if self.prepare:
+            for job in self.protoJobs:
+                self.doPrepare(job)
+            self.finishPrepare()
+
         # loop over protojobs
         for job in self.protoJobs:
             self.runPerJob(job)
@@ -196,15 +381,14 @@ class jobSubmitter(object):
 
     def initRun(self):
         self.initStep1()
+
+    def initModes(self):
         if self.missing:
             self.initMissing()
         elif self.clean:
             self.initClean()
 
     def runPerJob(self,job):
-        if self.prepare:
-            self.doPrepare(job)
-
         # mutually exclusive
         if self.count:
             self.doCount(job)
@@ -218,6 +402,8 @@ class jobSubmitter(object):
     def finishRun(self):
         if self.count:
             self.finishCount()
+        elif self.submit:
+            self.finishSubmit()
         elif self.missing:
             self.finishMissing()
         elif self.clean:
@@ -227,15 +413,27 @@ class jobSubmitter(object):
         # control options
         parser.add_option("-c", "--count", dest="count", default=False, action="store_true", help="count the expected number of jobs (default = %default)")
         parser.add_option("-p", "--prepare", dest="prepare", default=False, action="store_true", help="prepare job inputs and JDL files (default = %default)")
+        parser.add_option("--prepare-procs", dest="prepareProcs", default=1, type="int", help="number of processes to write JDL files in prepare mode (default = %default)")
+        parser.add_option("--prepare-force", dest="prepareForce", default=False, action="store_true", help="rewrite all JDL files in prepare mode, even if unchanged (default = %default)")
         parser.add_option("-s", "--submit", dest="submit", default=False, action="store_true", help="submit jobs to condor (default = %default)")
         parser.add_option("-m", "--missing", dest="missing", default=False, action="store_true", help="check for missing jobs (default = %default)")
         parser.add_option("-r", "--resub", dest="resub", default="", help="make a resub script with specified name (default = %default)")
         parser.add_option("--min-date", dest="minDate", type="string", default=None, action="callback", callback=date_callback, help="minimum date for files in missing mode (default = %default)")
         parser.add_option("--max-date", dest="maxDate", type="string", default=None, action="callback", callback=date_callback, help="maximum date for files in missing mode (default = %default)")
+        parser.add_option("--query-threads", dest="queryThreads", default=8, type="int", help="number of schedds to query concurrently in missing mode (default = %default)")
+        parser.add_option("--query-timeout", dest="queryTimeout", default=300, type="int", help="timeout in seconds for each schedd query in missing mode, 0 to disable (default = %default)")
+        parser.add_option("--list-threads", dest="listThreads", default=4, type="int", help="number of output dirs to list concurrently in missing mode (default = %default)")
+        parser.add_option("--ledger", dest="ledger", default="", help="database file to keep track of finished jobs between runs of missing and clean modes (default = %default)")
+        parser.add_option("--ledger-reset", dest="ledgerReset", default=False, action="store_true", help="list all output files again instead of only new ones when using the ledger (default = %default)")
         parser.add_option("-l", "--clean", dest="clean", default=False, action="store_true", help="clean up log files (default = %default)")
         parser.add_option("--clean-dir", dest="cleanDir", default=".", help="output dir for log file .tar.gz (default = %default)")
+        parser.add_option("--clean-compress", dest="cleanCompress", default="gzip", type="choice", choices=["gzip","zstd"], help="compression for log archive: gzip (uses pigz if available) or zstd (default = %default)")
+        parser.add_option("--clean-threads", dest="cleanThreads", default=4, type="int", help="number of threads for log archive compression (default = %default)")
+        parser.add_option("--clean-append", dest="cleanAppend", default=False, action="store_true", help="append to today's log archive in local dir instead of creating a new one (default = %default)")
+        parser.add_option("--log-dirs", dest="logDirs", default=["."], type="string", action="callback", callback=list_callback, help="comma-separated list of dirs containing log files for clean mode (default = %default)")
         parser.add_option("-u", "--user", dest="user", default=parser_dict["common"]["user"], help="view jobs from this user (submitter) (default = %default)")
         parser.add_option("-q", "--no-queue-arg", dest="noQueueArg", default=False, action="store_true", help="don't use -queue argument in condor_submit (default = %default)")
+        parser.add_option("--bulk", dest="bulk", default=False, action="store_true", help="submit all JDLs (or all resubmissions in missing mode) using the htcondor bindings instead of condor_submit (default = %default)")
         self.modes.update({
             "count": 1,
             "prepare": 0,
@@ -269,6 +467,8 @@ class jobSubmitter(object):
         parser.add_option("-n", "--no-voms", dest="novoms", default=False, action="store_true", help="skip check and use of voms proxy (default = %default)")
         parser.add_option("-t", "--cmssw-method", dest="cmsswMethod", default="transfer", help="how to get CMSSW env: transfer, cmsrel, or address for xrdcp (default = %default)")
         parser.add_option("--scram-workaround", dest="scramWorkaround", default=False, action="store_true", help="workaround for scram ProjectRename bug (default = %default)")
+        parser.add_option("--cmssw-cache", dest="cmsswCache", default="", help="node-local dir to cache unpacked CMSSW tarball for jobs on the same worker node (default = %default)")
+        parser.add_option("--cmssw-cache-size", dest="cmsswCacheSize", default=20, type="int", help="maximum size of node-local CMSSW cache in GB (default = %default)")
 
     def checkStep1Options(self,options,parser):
         if options.cmsswMethod!="transfer" and options.cmsswMethod!="cmsrel" and not options.cmsswMethod.startswith("root://"):
@@ -278,6 +478,8 @@ class jobSubmitter(object):
             options.keep = True
         if options.novoms and options.cmsswMethod.startswith("root://"):
             parser.error("Can't xrdcp CMSSW without voms proxy!")
+        if len(options.cmsswCache)>0 and (options.cmsswMethod=="cmsrel" or options.scramWorkaround):
+            parser.error("CMSSW cache can only be used with CMSSW tarball (and without scram workaround)")
 
     def addExtraOptions(self,parser):
         # job options
@@ -319,21 +521,52 @@ class jobSubmitter(object):
             sp.wait()
 
     def initMissing(self):
+        if len(self.ledger)>0:
+            self.jobLedger = jobLedger(self.ledger)
+
         # find finished jobs via output file list
         self.filesSet = self.findFinished()
+        self.filesIndex = index_names(self.filesSet)
 
         # find running jobs from condor
         self.runSet = self.findRunning()
+        self.runIndex = index_names(self.runSet)
 
     def initClean(self):
         self.initMissing()
         # subtract running jobs from finished jobs (in case resubmitted)
         self.filesSet = self.filesSet - self.runSet
+        if self.jobLedger is not None:
+            self.cleanedSet = self.jobLedger.getFinished(cleaned=True)
 
         self.logdir = "logs"
         if not os.path.isdir(self.logdir):
             os.mkdir(self.logdir)
 
+        # scan log dirs once, instead of once per job
+        self.logIndex = self.indexLogs(self.filesSet)
+        self.logMoves = []
+
+    # index log files by job name, equivalent to glob(jobname+"_*.*") for each job name in names
+    def indexLogs(self,names):
+        logIndex = defaultdict(list)
+        for logDir in self.logDirs:
+            if hasattr(os,"scandir"):
+                fnames = [entry.name for entry in os.scandir(logDir) if entry.is_file()]
+            else:
+                fnames = [fname for fname in os.listdir(logDir) if os.path.isfile(os.path.join(logDir,fname))]
+            for fname in fnames:
+                # glob does not match hidden files
+                if fname.startswith("."): continue
+                # the job name can end at any underscore
+                pos = fname.find("_")
+                while pos>=0:
+                    prefix = fname[:pos]
+                    if prefix in names and "." in fname[pos+1:]:
+                        logIndex[prefix].append((logDir,fname))
+                    pos = fname.find("_",pos+1)
+        return logIndex
+
     def generateDefault(self,job):
         job.patterns["SCRIPTARGS"] = ",".join(self.scripts)
 
@@ -347,6 +580,9 @@ class jobSubmitter(object):
         if self.cmsswMethod.startswith("root://"):
             # xrdcp needs input dir
             step1args += " -X "+self.cmsswMethod
+        if len(self.cmsswCache)>0:
+            # unpacked tarball can be reused by jobs on the same node
+            step1args += " -K "+self.cmsswCache+" -M "+str(self.cmsswCacheSize)
         job.patterns["STEP1ARGS"] = step1args
         if self.cmsswMethod=="transfer":
             job.patterns["CMSSWVER"] = cmsswver
@@ -355,9 +591,21 @@ class jobSubmitter(object):
         if self.novoms:
             job.patterns["x509userproxy = $ENV(X509_USER_PROXY)\n"] = ""
 
+    # host information is only determined once per run
+    def getHostInfo(self):
+        if self.hostInfo is None:
+            hostname = os.uname()[1]
+            self.hostInfo = {
+                "cms_connect": hostname=="login.uscms.org" or hostname=="login-el7.uscms.org",
+                "umd": "umd.edu" in hostname,
+                "os_version": match("[^0-9]*([0-9]+).*","/etc/redhat-release"),
+            }
+        return self.hostInfo
+
     def generateExtra(self,job):
-        is_cms_connect = os.uname()[1]=="login.uscms.org" or os.uname()[1]=="login-el7.uscms.org"
-        os_version = match("[^0-9]*([0-9]+).*","/etc/redhat-release")
+        hostInfo = self.getHostInfo()
+        is_cms_connect = hostInfo["cms_connect"]
+        os_version = hostInfo["os_version"]
         job.patterns.update([
             ("OSVERSION","rhel"+os_version),
             ("MYDISK",self.disk),
@@ -371,7 +619,7 @@ class jobSubmitter(object):
             if len(self.sites)>0: job.appends.append("+DESIRED_Sites = \""+self.sites+"\"")
             job.appends.append("+AvoidSystemPeriodicRemove = True")
         # special option for UMD
-        if "umd.edu" in os.uname()[1]:
+        if hostInfo["umd"]:
             if 'slc7' in os.environ['SCRAM_ARCH']:
                 job.appends.append("Requirements = (TARGET.OpSysMajorVer == 7)")
             else:
@@ -387,22 +635,83 @@ class jobSubmitter(object):
     def finishCount(self):
         print(str(self.njobs)+" jobs")
 
+    # record of JDL contents from previous prepare runs: jdl -> [hash, mtime, size]
+    def getManifestName(self):
+        return self.jdl.replace(".jdl","_manifest.json")
+
+    def loadManifest(self):
+        self.manifest = {}
+        if os.path.isfile(self.getManifestName()):
+            try:
+                with open(self.getManifestName(),'r') as mfile:
+                    self.manifest = json.load(mfile)
+            except ValueError:
+                print("Warning: ignoring unreadable manifest "+self.getManifestName())
+
+    def saveManifest(self):
+        tmpname = self.getManifestName()+".tmp"
+        with open(tmpname,'w') as mfile:
+            json.dump(self.manifest,mfile)
+        os.rename(tmpname,self.getManifestName())
+
+    # unchanged if inputs have same hash and file was not modified since it was written
+    def jdlUnchanged(self,jdl,digest):
+        if self.prepareForce or jdl not in self.manifest or not os.path.isfile(jdl): return False
+        st = os.stat(jdl)
+        return self.manifest[jdl]==[digest, st.st_mtime, st.st_size]
+
     def doPrepare(self,job):
         # get template contents (move into separate fn/store in self?)
         if len(self.jdlLines)==0:
             with open(self.jdl,'r') as jdlfile:
                 self.jdlLines = jdlfile.readlines()
-        # replace patterns
-        pysed(self.jdlLines,job.jdl,job.patterns)
-        # append appends & queue
-        with open(job.jdl,'a') as outfile:
-            for append_ in job.appends:
-                outfile.write(append_+"\n")
-            if self.noQueueArg: outfile.write(job.queue.replace("-queue","Queue")+"\n")
-            else: outfile.write("# "+job.queue.replace("-queue","Queue")+"\n")
+        if self.jdlCompiled is None:
+            self.jdlCompiled = jdlTemplate(self.jdlLines)
+            self.jdlDigest = hashlib.sha1("".join(self.jdlLines).encode("utf-8")).hexdigest()
+            init_prepare(self.jdlCompiled)
+        if self.manifest is None:
+            self.loadManifest()
+        # replace patterns, then append appends & queue
+        patterns = [(str(pattern),str(replace)) for pattern,replace in six.iteritems(job.patterns)]
+        tail = "".join([append_+"\n" for append_ in job.appends])
+        if self.noQueueArg: tail += job.queue.replace("-queue","Queue")+"\n"
+        else: tail += "# "+job.queue.replace("-queue","Queue")+"\n"
+        digest = hashlib.sha1(json.dumps([self.jdlDigest,patterns,tail]).encode("utf-8")).hexdigest()
+        if self.jdlUnchanged(job.jdl,digest):
+            self.prepareCounts[1] += 1
+        # defer to finishPrepare if writing in parallel
+        elif self.prepareProcs>1:
+            self.prepareEntries.append(((job.jdl,patterns,tail),digest))
+        else:
+            self.recordJdl(write_jdl((job.jdl,patterns,tail)),digest)
+
+    def recordJdl(self,written,digest):
+        jdl, mtime, size = written
+        self.manifest[jdl] = [digest, mtime, size]
+        self.prepareCounts[0] += 1
+
+    def finishPrepare(self):
+        if len(self.prepareEntries)>0:
+            from multiprocessing import Pool
+            pool = Pool(min(self.prepareProcs,len(self.prepareEntries)), init_prepare, (self.jdlCompiled,))
+            try:
+                written = pool.map(write_jdl, [entry for entry,digest in self.prepareEntries])
+            finally:
+                pool.close()
+                pool.join()
+            for result,(entry,digest) in zip(written,self.prepareEntries):
+                self.recordJdl(result,digest)
+            self.prepareEntries = []
+        if self.manifest is not None:
+            self.saveManifest()
+        print("Prepared "+str(self.prepareCounts[0])+" JDL file(s), "+str(self.prepareCounts[1])+" unchanged")
 
     def doSubmit(self,job):
         if os.path.isfile(job.jdl):
+            # defer to finishSubmit
+            if self.bulk:
+                self.submitEntries.append((job.jdl, None if self.noQueueArg else job.queue))
+                return
             if self.noQueueArg:
                 cmd = "condor_submit "+job.jdl
             else:
@@ -415,36 +724,64 @@ class jobSubmitter(object):
         else:
             print("Error: couldn't find "+job.jdl+", try running in prepare mode")
 
+    def finishSubmit(self):
+        if len(self.submitEntries)==0: return
+        bulk = self.tryToGetCondor()
+        if not bulk: print("Bulk submission not available, using condor_submit instead")
+        submit_entries(self.submitEntries, bulk)
+
     def editMissing(self,numlist,jdl,noQueueArg):
         returnLines = []
+        # short lists are given inline, long lists in an item file next to the jdl
+        items = ','.join(map(str,numlist))
+        if len(items)<=self.inlineQueueMax:
+            queue = "Process in "+items
+        else:
+            itemfile = jdl.replace(".jdl","_missing.txt")
+            write_if_changed(itemfile,'\n'.join(map(str,numlist))+'\n')
+            queue = "Process from "+itemfile
         if noQueueArg:
             # get jdl lines for this job
             with open(jdl,'r') as file:
                 jdlLines = [line for line in file]
             # overwrite queue command in jdl
-            with open(jdl,'w') as file:
-                for line in jdlLines:
-                    if line.startswith("Queue"):
-                        file.write("#"+line)
-                        file.write("Queue Process in "+','.join(map(str,numlist))+"\n")
-                    else:
-                        file.write(line)
+            newLines = []
+            for line in jdlLines:
+                if line.startswith("Queue"):
+                    # replace the queue command from a previous resubmission, comment out the original
+                    if len(newLines)==0 or not newLines[-1].startswith("#Queue"):
+                        newLines.append("#"+line)
+                    newLines.append("Queue "+queue+"\n")
+                else:
+                    newLines.append(line)
+            write_if_changed(jdl,''.join(newLines))
             returnLines.append('condor_submit '+jdl)
+            self.resubEntries.append((jdl,None))
         else:
-            returnLines.append('condor_submit '+jdl+' -queue "Process in '+','.join(map(str,numlist))+'"')
+            returnLines.append('condor_submit '+jdl+' -queue "'+queue+'"')
+            self.resubEntries.append((jdl,queue))
         return returnLines
 
     def doMissing(self,job):
-        jobSet, jobDict = self.findJobs(job)
-        # replace name if necessary
-        if len(job.chainName)>0:
-            runSetTmp = {x.replace(job.chainName,job.name) for x in self.runSet}
+        if job.hasDefaultNames():
+            # find difference using job numbers
+            finished = self.filesIndex.get(job.name,())
+            running = self.runIndex.get(job.name,())
+            # running jobs may use the chain name
+            runningChain = self.runIndex.get(job.chainName,()) if len(job.chainName)>0 else ()
+            numlist = sorted(set(num for num in job.nums if num not in finished and num not in running and num not in runningChain))
+            diffList = sorted(job.makeName(num) for num in numlist)
         else:
-            runSetTmp = self.runSet
-        # find difference
-        diffSet = jobSet - self.filesSet - runSetTmp
-        diffList = list(sorted(diffSet))
-        numlist = sorted([jobDict[j] for j in diffList])
+            jobSet, jobDict = self.findJobs(job)
+            # replace name if necessary
+            if len(job.chainName)>0:
+                runSetTmp = {x.replace(job.chainName,job.name) for x in self.runSet}
+            else:
+                runSetTmp = self.runSet
+            # find difference
+            diffSet = jobSet - self.filesSet - runSetTmp
+            diffList = list(sorted(diffSet))
+            numlist = sorted([jobDict[j] for j in diffList])
         if len(diffList)>0:
             if len(self.resub)>0:
                 self.missingLines.extend(self.editMissing(numlist,job.jdl,self.noQueueArg))
@@ -470,6 +807,8 @@ class jobSubmitter(object):
                 print('\n'.join(self.missingLines))
         else:
             print("No missing jobs!")
+        if self.jobLedger is not None:
+            self.jobLedger.close()
 
     def finishedToJobName(self,val):
         return val.split("/")[-1].replace(".root","")
@@ -478,29 +817,74 @@ class jobSubmitter(object):
         # find finished jobs via output file list
         filesSet = set()
         if hasattr(self,"output"):
-            files = generalized_ls(self.output,"",self.minDate,self.maxDate)
-            # basename
-            filesSet = set([ self.finishedToJobName(f) for f in files])
+            # output can be one dir, a comma-separated string, or a list of dirs
+            outputs = self.output.split(',') if isinstance(self.output,six.string_types) else list(self.output)
+            # only look at files newer than the last listing, unless dates are specified
+            useLedger = self.jobLedger is not None and self.minDate is None and self.maxDate is None
+            minDate = self.minDate
+            if useLedger:
+                syncKey = "sync:"+",".join(outputs)
+                lastSync = self.jobLedger.getMeta(syncKey)
+                if lastSync is not None and not self.ledgerReset: minDate = date_convert(lastSync)
+                # margin for files still being written during the listing and for time zone differences
+                thisSync = (datetime.now()-timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+            # list all output dirs concurrently, streaming the basenames into the set
+            filesSet = set(self.finishedToJobName(record[0]) for record in ls_many(outputs,minDate,self.maxDate,self.listThreads))
+            if useLedger:
+                if minDate is None: self.jobLedger.resetFinished(filesSet)
+                else: self.jobLedger.setFinished(filesSet)
+                self.jobLedger.setMeta(syncKey,thisSync)
+                filesSet = self.jobLedger.getFinished()
         return filesSet
 
     def tryToGetCondor(self):
-        # try to find condor bindings
-        if six.PY2:
-            for condorPath in glob.glob("/usr/lib64/python{}.*/site-packages".format(sys.version_info[0])):
-                if condorPath not in sys.path and os.path.isdir(condorPath):
-                    sys.path.append(condorPath)
-        # try to import condor bindings
-        try:
-            global htcondor,classad
-            import htcondor,classad
-        except:
-            print('Could not import htcondor bindings!')
-            return False
-        return True
+        return get_condor()
 
     def runningToJobName(self,val):
         return "_".join(val.replace(".stdout","").split('_')[:-1])
 
+    # protoJobs that may have running jobs (all of them, unless the ledger knows they are finished)
+    def findPending(self):
+        if self.jobLedger is None: return self.protoJobs
+        return [job for job in self.protoJobs if (
+            any(num not in self.filesIndex.get(job.name,()) for num in job.nums) if job.hasDefaultNames()
+            else any(job.makeName(num) not in self.filesSet for num in job.nums)
+        )]
+
+    # only ask for jobs whose stdout name matches one of the protoJobs being checked
+    def runningConstraint(self,jobs=None):
+        if jobs is None: jobs = self.protoJobs
+        # exclude removed jobs
+        constraint = "JobStatus!=3"
+        if len(self.user)>0: constraint += ' && Owner=="'+self.user+'"'
+        # the stdout names can only be assumed to start with the job names if the default naming scheme is used
+        defaultRunning = getattr(self.runningToJobName,"__func__",None) is jobSubmitter.__dict__["runningToJobName"]
+        if not defaultRunning or not all(job.hasDefaultNames() for job in jobs):
+            return constraint
+        prefixes = []
+        for prefix in sorted(set(job.chainName if len(job.chainName)>0 else job.name for job in jobs)):
+            if len(prefix)==0:
+                prefixes = []
+                break
+            # skip prefixes already covered by a shorter one
+            if len(prefixes)>0 and prefix.startswith(prefixes[-1]): continue
+            prefixes.append(prefix)
+        if len(prefixes)>0:
+            constraint += " && ("+" || ".join(
+                'substr(Out,0,{}) =?= "{}"'.format(len(prefix),prefix.replace('\\','\\\\').replace('"','\\"')) for prefix in prefixes
+            )+")"
+        return constraint
+
+    def queryRunning(self,task):
+        collector, sch, constraint = task
+        if len(collector)==0:
+            coll = htcondor.Collector()
+        else:
+            coll = htcondor.Collector(collector)
+        scheddAd = coll.locate(htcondor.DaemonTypes.Schedd, sch)
+        schedd = htcondor.Schedd(scheddAd)
+        return [self.runningToJobName(result["Out"]) for result in schedd.xquery(constraint,["Out"])]
+
     def findRunning(self):
         runSet = set()
 
@@ -509,34 +893,46 @@ class jobSubmitter(object):
             print('"Missing jobs" check will not consider running jobs.')
             return runSet
 
-        # exclude removed jobs
-        constraint = "JobStatus!=3"
-        if len(self.user)>0: constraint += ' && Owner=="'+self.user+'"'
+        pending = self.findPending()
+        if len(pending)==0: return runSet
+        constraint = self.runningConstraint(pending)
+        tasks = []
         for cname, collector in six.iteritems(parser_dict["collectors"]):
             if cname not in parser_dict["schedds"]:
                 print("Error: no schedds provided for collector "+cname+", so it will be skipped.")
                 continue
-            else:
-                if len(collector)==0:
-                    coll = htcondor.Collector()
-                else:
-                    coll = htcondor.Collector(collector)
             for sch in parser_dict["schedds"][cname].split(','):
-                try:
-                    scheddAd = coll.locate(htcondor.DaemonTypes.Schedd, sch)
-                    schedd = htcondor.Schedd(scheddAd)
-                    for result in schedd.xquery(constraint,["Out"]):
-                        runSet.add(self.runningToJobName(result["Out"]))
-                except:
-                    print("Warning: could not locate schedd "+sch)
+                tasks.append((collector,sch,constraint))
+
+        # query all schedds concurrently
+        for (collector,sch,constraint), result, error in run_tasks(self.queryRunning, tasks, self.queryThreads, self.queryTimeout):
+            if isinstance(error,TaskTimeout):
+                print("Warning: timed out querying schedd "+sch)
+            elif error is not None:
+                print("Warning: could not locate schedd "+sch)
+            else:
+                runSet.update(result)
 
         return runSet
 
     def makeResubmit(self, resub, missingLines):
         with open(resub,'w') as rfile:
             rfile.write("#!/bin/bash\n\n")
-            for stmp in missingLines:
-                rfile.write(stmp+'\n')
+            if self.bulk and len(self.resubEntries)>0:
+                # submit all missing jobs using the bindings (which fall back to condor_submit themselves), or condor_submit if unavailable
+                rfile.write(sys.executable+" - <<'EOF' || {\n")
+                rfile.write("import sys\n")
+                rfile.write("from Condor.Production.jobSubmitter import get_condor, submit_entries\n")
+                rfile.write("if not get_condor(): sys.exit(1)\n")
+                rfile.write("submit_entries("+repr(self.resubEntries)+")\n")
+                rfile.write("EOF\n")
+                rfile.write('echo "Bulk submission not available, using condor_submit instead"\n')
+                for stmp in missingLines:
+                    rfile.write(stmp+'\n')
+                rfile.write("}\n")
+            else:
+                for stmp in missingLines:
+                    rfile.write(stmp+'\n')
         # make executable
         st = os.stat(rfile.name)
         os.chmod(rfile.name, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
@@ -547,53 +943,119 @@ class jobSubmitter(object):
         finishedJobSet = jobSet & self.filesSet
         # remove these jobs from global list
         self.filesSet = self.filesSet - jobSet
+        # skip jobs with logs already archived
+        if self.jobLedger is not None:
+            finishedJobSet = finishedJobSet - self.cleanedSet
+        self.cleanedNames.extend(finishedJobSet)
 
         for jobname in finishedJobSet:
             # gets .condor, .stdout, .stderr
-            for fname in glob.glob(jobname+"_*.*"):
-                shutil.move(fname,self.logdir)
+            self.logMoves.extend(self.logIndex.pop(jobname,[]))
+
+    # move all log files at once, keeping the subdir structure of the log dirs
+    def moveLogs(self):
+        moved = set()
+        for logDir, fname in self.logMoves:
+            # a file can match more than one job name
+            if (logDir,fname) in moved: continue
+            moved.add((logDir,fname))
+            subdir = os.path.relpath(logDir)
+            if subdir.startswith(os.pardir): subdir = os.path.abspath(logDir).lstrip("/")
+            outdir = os.path.normpath(os.path.join(self.logdir,subdir))
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            try:
+                os.rename(os.path.join(logDir,fname),os.path.join(outdir,fname))
+            except OSError:
+                # e.g. different filesystem
+                shutil.move(os.path.join(logDir,fname),os.path.join(outdir,fname))
+        self.logMoves = []
 
     def finishClean(self):
+        self.moveLogs()
+
         # check if nothing to do
         if len(os.listdir(self.logdir))==0:
             # remove tmp dir
             shutil.rmtree(self.logdir)
+            self.finishCleanLedger(True)
             return
 
-        # create compressed tarfile
-        logname = "logs_tmp.tar.gz"
-        with tarfile.open(logname,"w:gz") as tar:
-            tar.add(self.logdir,arcname=self.logdir)
-
-        num_logs = 0
-        # check what is already in dir
         if len(self.cleanDir)==0: self.cleanDir = "."
-        if self.cleanDir.startswith("root://"):
-            # xrootd dir
-            files = pyxrdfsls(self.cleanDir)
-            files = [f for f in files if f.endswith(".tar.gz")]
+        remote = self.cleanDir.startswith("root://")
+        ext = ".tar.zst" if self.cleanCompress=="zstd" else ".tar.gz"
+        if self.cleanAppend and not remote:
+            # one archive per day, with new logs appended as additional gzip members or zstd frames
+            logname = "logs_"+datetime.now().strftime("%Y-%m-%d")+ext
+        else:
+            num_logs = 0
+            # check what is already in dir
+            if remote:
+                # xrootd dir
+                files = pyxrdfsls(self.cleanDir)
+            else:
+                # local dir
+                files = os.listdir(self.cleanDir)
+            nums = [int(num) for num in (os.path.basename(f)[5:-len(ext)] for f in files if os.path.basename(f).startswith("logs_") and f.endswith(ext)) if num.isdigit()]
+            if len(nums)>0:
+                num_logs = max(nums)+1
+            logname = "logs_"+str(num_logs)+ext
+        dest = self.cleanDir+"/"+logname
+
+        # stream tar output through the compressor directly to the destination (no local tmp archive)
+        compress = find_exe("zstd" if self.cleanCompress=="zstd" else "pigz")
+        if compress is None:
+            if self.cleanCompress=="zstd":
+                print("zstd not found, logs not archived")
+                self.finishCleanLedger(False)
+                return
+            compress = ["gzip","-c"]
+        elif self.cleanCompress=="zstd":
+            compress = [compress,"-q","-c","-T"+str(self.cleanThreads)]
         else:
-            # local dir
-            files = glob.glob(logname.replace("tmp","*"))
-
-        files = [f for f in files if f!=logname]
-        if len(files)>0:
-            num_logs = max([int(f.split("_")[-1].replace(".tar.gz","")) for f in files])+1
-        logname2 = logname.replace("tmp",str(num_logs))
-
-        rc = 1
-        # copy to dir
-        if self.cleanDir.startswith("root://"):
-            # xrootd dir
-            rc = pyxrdcp(logname,self.cleanDir+"/"+logname2)
+            compress = [compress,"-c","-p",str(self.cleanThreads)]
+
+        procs = []
+        tarp = subprocess.Popen(["tar","-cf","-",self.logdir], stdout=subprocess.PIPE)
+        procs.append(tarp)
+        if remote:
+            comp = subprocess.Popen(compress, stdin=tarp.stdout, stdout=subprocess.PIPE)
+            procs.append(comp)
+            tarp.stdout.close()
+            xrdcp = subprocess.Popen(["xrdcp","-s","-",dest], stdin=comp.stdout, env=dict(os.environ,**xrd_env))
+            procs.append(xrdcp)
+            comp.stdout.close()
         else:
-            # local dir
-            shutil.copy2(logname,self.cleanDir+"/"+logname2)
-            rc = 0
+            # write to a tmp file (or the end of today's archive) and only keep it if successful
+            tmpname = dest if self.cleanAppend else dest+".tmp"
+            oldsize = os.path.getsize(tmpname) if os.path.isfile(tmpname) else 0
+            outfile = open(tmpname,'ab' if self.cleanAppend else 'wb')
+            comp = subprocess.Popen(compress, stdin=tarp.stdout, stdout=outfile)
+            procs.append(comp)
+            tarp.stdout.close()
+        # wait for the whole pipeline to exit before deciding what to keep
+        rcs = [proc.wait() for proc in procs]
+        rc = next((rc for rc in rcs if rc!=0),0)
+        if not remote:
+            outfile.close()
+            if rc!=0:
+                if self.cleanAppend:
+                    with open(tmpname,'ab') as file:
+                        file.truncate(oldsize)
+                else:
+                    os.remove(tmpname)
+            elif not self.cleanAppend:
+                os.rename(tmpname,dest)
 
         if rc==0:
-            print("copied logs to "+self.cleanDir+"/"+logname2)
-            # remove tmp file
-            os.remove(logname)
+            print(("appended logs to " if self.cleanAppend and not remote else "copied logs to ")+dest)
             # remove tmp dir
             shutil.rmtree(self.logdir)
+        else:
+            print("exit code "+str(rc)+", failure in archiving logs to "+dest)
+        self.finishCleanLedger(rc==0)
+
+    def finishCleanLedger(self,cleaned):
+        if self.jobLedger is None: return
+        if cleaned: self.jobLedger.setCleaned(self.cleanedNames)
+        self.jobLedger.close()
@@ -0,0 +1,167 @@
+from __future__ import print_function
+import os, six
+import htcondor
+
+# job status from each event type (as in the JobStatus ClassAd: 1 is idle, 2 is running, 3 is removed, 4 is finished, 5 is held)
+event_status = {
+    htcondor.JobEventType.SUBMIT: 1,
+    htcondor.JobEventType.EXECUTE: 2,
+    htcondor.JobEventType.JOB_EVICTED: 1,
+    htcondor.JobEventType.JOB_RECONNECT_FAILED: 1,
+    htcondor.JobEventType.JOB_HELD: 5,
+    htcondor.JobEventType.JOB_RELEASED: 1,
+    htcondor.JobEventType.JOB_TERMINATED: 4,
+    htcondor.JobEventType.JOB_ABORTED: 3,
+}
+
+# transitions that are reported
+event_names = {
+    htcondor.JobEventType.JOB_EVICTED: "evicted",
+    htcondor.JobEventType.JOB_HELD: "held",
+    htcondor.JobEventType.JOB_TERMINATED: "finished",
+    htcondor.JobEventType.JOB_ABORTED: "removed",
+}
+
+class watchedJob(object):
+    __slots__ = ["stdout","num","status","why"]
+    def __init__(self,stdout,num,status=1,why=""):
+        self.stdout = stdout
+        self.num = num
+        self.status = status
+        self.why = why
+
+    @property
+    def name(self):
+        return "_".join(self.stdout.split('_')[:-1])
+
+class transition(object):
+    __slots__ = ["job","what","detail","timestamp"]
+    def __init__(self,job,what,detail,timestamp):
+        self.job = job
+        self.what = what
+        self.detail = detail
+        self.timestamp = timestamp
+
+def event_detail(event):
+    if event.type==htcondor.JobEventType.JOB_HELD:
+        return event["HoldReason"] if "HoldReason" in event else ""
+    elif event.type==htcondor.JobEventType.JOB_TERMINATED:
+        if not event.get("TerminatedNormally",True): return "signal "+str(event.get("TerminatedBySignal",""))
+        return "exit code "+str(event.get("ReturnValue",""))
+    elif event.type==htcondor.JobEventType.JOB_ABORTED:
+        return event["Reason"] if "Reason" in event else ""
+    return ""
+
+# keeps a table of job states from the user job event logs (*.condor) in the given dirs
+# each log is kept open, and only new events are read from logs that changed since the previous update
+# query: function returning ClassAds of the user's jobs (ClusterId, ProcId, JobStatus, HoldReason, Out) from the schedd,
+# used to initialize the table and to resynchronize if an event cannot be explained (None to only use the logs, e.g. to replay a recorded log)
+class jobWatcher(object):
+    def __init__(self,dirs,query=None,ext=".condor"):
+        self.dirs = dirs
+        self.query = query
+        self.ext = ext
+        # log file -> (inode, size, mtime, JobEventLog)
+        self.logs = {}
+        # job number -> watchedJob
+        self.jobs = {}
+        self.outOfSync = False
+
+    def scan(self):
+        logs = {}
+        for logDir in self.dirs:
+            if hasattr(os,"scandir"):
+                entries = ((entry.name, entry.stat) for entry in os.scandir(logDir) if entry.name.endswith(self.ext) and entry.is_file())
+            else:
+                entries = ((name, lambda name=name: os.stat(os.path.join(logDir,name))) for name in os.listdir(logDir) if name.endswith(self.ext))
+            for name, getstat in entries:
+                logs[os.path.join(logDir,name)] = getstat()
+        return logs
+
+    # read new events from all logs, returns list of transitions (empty if quiet)
+    def update(self,quiet=False):
+        transitions = []
+        logs = self.scan()
+        # removed logs (e.g. by clean mode): stop watching
+        for fname in set(self.logs)-set(logs):
+            self.logs.pop(fname)[3].close()
+        for fname, stat in six.iteritems(logs):
+            inode, size, mtime, log = self.logs.get(fname,(None,0,0,None))
+            if inode==stat.st_ino and size==stat.st_size and mtime==stat.st_mtime: continue
+            # replaced or truncated: read again from the start (without reporting), and check with the schedd
+            replaced = inode is not None and (inode!=stat.st_ino or stat.st_size<size)
+            if replaced:
+                log.close()
+                log = None
+                self.outOfSync = True
+            if log is None: log = htcondor.JobEventLog(fname)
+            self.readLog(log, fname, transitions, quiet or replaced)
+            self.logs[fname] = (stat.st_ino, stat.st_size, stat.st_mtime, log)
+        if self.outOfSync and self.query is not None:
+            self.sync()
+        # events from different logs in time order
+        transitions.sort(key=lambda t: t.timestamp)
+        return transitions
+
+    # events after the last one read (the iterator does not wait for new events)
+    def readLog(self,log,fname,transitions,quiet):
+        stdout = os.path.basename(fname)[:-len(self.ext)]
+        for event in log.events(stop_after=0):
+            result = self.handle(event,stdout)
+            if result is not None and not quiet: transitions.append(result)
+
+    def handle(self,event,stdout):
+        if event.type not in event_status: return None
+        num = "{}.{}".format(event.cluster,event.proc)
+        if num not in self.jobs:
+            # only a new job should be unknown
+            if event.type!=htcondor.JobEventType.SUBMIT: self.outOfSync = True
+            self.jobs[num] = watchedJob(stdout,num)
+        job = self.jobs[num]
+        job.status = event_status[event.type]
+        detail = event_detail(event)
+        job.why = detail if job.status==5 else ""
+        if event.type in event_names:
+            return transition(job,event_names[event.type],detail,event.timestamp)
+        return None
+
+    # correct the job table using the schedd, returns number of jobs changed
+    def sync(self):
+        self.outOfSync = False
+        try:
+            ads = list(self.query())
+        except Exception as e:
+            print("Warning: could not query schedd ("+str(e)+")")
+            return 0
+        names = set(job.stdout for job in six.itervalues(self.jobs))
+        found = set()
+        changed = 0
+        for ad in ads:
+            num = str(ad["ClusterId"])+"."+str(ad["ProcId"])
+            stdout = os.path.basename(str(ad["Out"])).replace(".stdout","") if "Out" in ad else ""
+            if num not in self.jobs:
+                if stdout not in names: continue
+                self.jobs[num] = watchedJob(stdout,num,0)
+            found.add(num)
+            job = self.jobs[num]
+            status = int(ad["JobStatus"])
+            if job.status!=status:
+                job.status = status
+                job.why = str(ad["HoldReason"]) if status==5 and "HoldReason" in ad else ""
+                changed += 1
+        # jobs that left the queue without a terminal event in the logs
+        for num, job in six.iteritems(self.jobs):
+            if num not in found and job.status in [1,2,5]:
+                job.status = 4
+                changed += 1
+        return changed
+
+    def close(self):
+        for fname in list(self.logs):
+            self.logs.pop(fname)[3].close()
+
+    def counts(self):
+        counts = {}
+        for job in six.itervalues(self.jobs):
+            counts[job.status] = counts.get(job.status,0)+1
+        return counts
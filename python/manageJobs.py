@@ -1,6 +1,7 @@
 from __future__ import print_function
-import sys,os,subprocess,glob,shutil,json,six
+import sys,os,subprocess,glob,shutil,json,time,copy,six
 from optparse import OptionParser, OptionGroup
+from collections import OrderedDict
 from file_finder import find_input_file_site_per_job, fprint
 
 # try to find condor bindings
@@ -11,6 +12,9 @@ if six.PY2:
 import htcondor,classad
 
 from parseConfig import list_callback, parser_dict
+from concurrentTasks import run_tasks, TaskTimeout
+from jobHistory import jobHistory
+from jobPolicy import jobPolicy
 
 class CondorJob(object):
     def __init__(self, options, result, schedd):
@@ -37,26 +41,38 @@ class CondorJob(object):
         self.time = (float(result["ChirpCMSSWElapsed"]) if "ChirpCMSSWElapsed" in result.keys() else 0.0)/float(3600)
         self.events = int(result["ChirpCMSSWEvents"]) if "ChirpCMSSWEvents" in result.keys() else 0
         self.rate = float(self.events)/(self.time*3600) if self.time>0 else 0
+        self.maxevents = int(result["ChirpCMSSWMaxEvents"]) if "ChirpCMSSWMaxEvents" in result.keys() else -1
+        self.servertime = int(result["ServerTime"]) if "ServerTime" in result.keys() else 0
+        self.update = int(result["ChirpCMSSWLastUpdate"]) if "ChirpCMSSWLastUpdate" in result.keys() else 0
+        # filled from the progress history, if used
+        self.recent = None
+        self.eta = None
+        self.stalled = None
         if options.inputFileClassAd in result.keys():
             self.inputFiles = result[options.inputFileClassAd]
 
-def getJob(options,result,jobs,scheddurl=""):
-    # check greps
-    checkstring = result["Out"]
-    if "HoldReason" in result.keys(): checkstring += " "+result["HoldReason"]
+def checkGrep(options,checkstring):
     gfound = False
     for gcheck in options.grep:
         if gcheck in checkstring:
             gfound = True
             break
-    if len(options.grep)>0 and not gfound: return
+    if len(options.grep)>0 and not gfound: return False
     vfound = False
     for vcheck in options.vgrep:
         if vcheck in checkstring:
             vfound = True
             break
-    if len(options.vgrep)>0 and vfound: return
-    if options.stuck:
+    if len(options.vgrep)>0 and vfound: return False
+    return True
+
+def getJob(options,result,jobs,scheddurl=""):
+    # check greps
+    checkstring = result["Out"]
+    if "HoldReason" in result.keys(): checkstring += " "+result["HoldReason"]
+    if not checkGrep(options,checkstring): return
+    # with the progress history, stuck jobs are selected later (based on their rate)
+    if options.stuck and len(options.history)==0:
         time = int(result["ServerTime"]) if "ServerTime" in result.keys() else 0
         update = int(result["ChirpCMSSWLastUpdate"]) if "ChirpCMSSWLastUpdate" in result.keys() else 0
         # look for jobs not updating for 12 hours
@@ -65,32 +81,47 @@ def getJob(options,result,jobs,scheddurl=""):
         else: return
     jobs.append(CondorJob(options,result,scheddurl))
 
+# located schedds are kept for the whole run (failures too, to avoid repeating them)
+schedd_cache = {}
 def getSchedd(scheddurl,coll=""):
+    key = (coll,scheddurl)
+    if key in schedd_cache: return schedd_cache[key]
     if len(scheddurl)>0:
         try:
-            if len(coll)>0: coll = htcondor.Collector(coll)
-            else: coll = htcondor.Collector() # defaults to local
-            scheddAd = coll.locate(htcondor.DaemonTypes.Schedd, scheddurl)
+            if len(coll)>0: collector = htcondor.Collector(coll)
+            else: collector = htcondor.Collector() # defaults to local
+            scheddAd = collector.locate(htcondor.DaemonTypes.Schedd, scheddurl)
             schedd = htcondor.Schedd(scheddAd)
         except:
             print("Warning: could not locate schedd "+scheddurl)
-            return None
+            schedd = None
     else:
         schedd = htcondor.Schedd() # defaults to local
+    schedd_cache[key] = schedd
     return schedd
 
-def getJobs(options, scheddurl=""):
+# list of (collector, schedd) pairs to query
+def getNodes(options):
+    if not options.all: return [(options.coll,"")]
+    nodes = []
+    for cname, schedds in six.iteritems(parser_dict["schedds"]):
+        # a collector given on the command line takes precedence
+        coll = options.coll if len(options.coll)>0 else parser_dict["collectors"][cname]
+        nodes.extend([(coll,sch) for sch in schedds.split(',') if len(sch)>0])
+    return nodes
+
+def getJobs(options, scheddurl="", coll=None):
     constraint = 'Owner=="'+options.user+'"'
     if options.held: constraint += ' && JobStatus==5'
     elif options.running: constraint += ' && JobStatus==2'
     elif options.idle: constraint += ' && JobStatus==1'
 
-    schedd = getSchedd(scheddurl,options.coll)
+    schedd = getSchedd(scheddurl,options.coll if coll is None else coll)
     if schedd is None: return []
 
     # get info for selected jobs
     jobs = []
-    props = ["ClusterId","ProcId","HoldReason","Out","Args","Arguments","JobStatus","ServerTime","ChirpCMSSWLastUpdate","ChirpCMSSWElapsed","ChirpCMSSWEvents","DESIRED_Sites","MATCH_EXP_JOB_GLIDEIN_CMSSite","RemoteHost","LastRemoteHost"]
+    props = ["ClusterId","ProcId","HoldReason","Out","Args","Arguments","JobStatus","ServerTime","ChirpCMSSWLastUpdate","ChirpCMSSWElapsed","ChirpCMSSWEvents","ChirpCMSSWMaxEvents","DESIRED_Sites","MATCH_EXP_JOB_GLIDEIN_CMSSite","RemoteHost","LastRemoteHost"]
     if options.inputFileClassAd:
         props.append(options.inputFileClassAd)
     if options.finished>0:
@@ -108,14 +139,129 @@ def printJobs(jobs, num=False, prog=False, stdout=False, why=False, matched=Fals
         (j.stdout if stdout else j.name)+
         (" ("+j.num+")" if num else "")+
         (" ({:d} events in {:.1f} hours = {:.1f} evt/sec)".format(j.events,j.time,j.rate) if prog else "")+
+        (" (recent {:.1f} evt/sec".format(j.recent)+(", ETA {:.1f} hours".format(j.eta) if j.eta is not None else "")+")" if prog and j.recent is not None else "")+
         (" : "+j.matched+", "+j.machine if matched and len(j.matched)>0 and len(j.machine)>0 else "")+
         (" : "+j.why if why and len(j.why)>0 else "")
         for j in jobs
     ]))
 
-def resubmitJobs(jobs,options,scheddurl=""):
+# throughput and ETA of running jobs for each production, from the progress history
+def printSummary(summary):
+    if len(summary)==0: return
+
+    print("Production summary:")
+    print("\n".join([
+        name+": {} running jobs, {:d} events".format(prod["jobs"],prod["events"])+
+        (" of {:d}".format(prod["maxevents"]) if prod["maxevents"]>0 else "")+
+        ", {:.1f} evt/sec (recent {:.1f} evt/sec)".format(prod["rate"],prod["recent"])+
+        (", ETA {:.1f} hours".format(prod["eta"]) if prod["unknown"]==0 else ", ETA unknown for {} jobs".format(prod["unknown"]))
+        for name,prod in six.iteritems(summary)
+    ]))
+
+def printTransitions(transitions, num=False, stdout=False):
+    if len(transitions)==0: return
+
+    print("\n".join([
+        time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(t.timestamp))+" "+
+        (t.job.stdout if stdout else t.job.name)+
+        (" ("+t.job.num+")" if num else "")+
+        " "+t.what+
+        (" : "+t.detail if len(t.detail)>0 else "")
+        for t in transitions
+    ]))
+    sys.stdout.flush()
+
+# follow the job event logs, querying the schedd only at the start (or if the logs do not match the known jobs)
+def watchJobs(options):
+    from jobWatcher import jobWatcher
+    def query():
+        schedd = getSchedd("",options.coll)
+        if schedd is None: return []
+        return schedd.xquery('Owner=="'+options.user+'"',["ClusterId","ProcId","JobStatus","HoldReason","Out"])
+    watcher = jobWatcher(options.watchDirs,query)
+    watcher.outOfSync = True
+    watcher.update(quiet=True)
+    counts = watcher.counts()
+    print("Watching {} jobs in {} logs: {} idle, {} running, {} held".format(len(watcher.jobs),len(watcher.logs),counts.get(1,0),counts.get(2,0),counts.get(5,0)))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(options.watchInterval)
+            transitions = [t for t in watcher.update() if checkGrep(options,t.job.stdout+" "+t.detail)]
+            printTransitions(transitions,options.num,options.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+# get the current stdout of a running job
+def tailJob(task):
+    jobnum, logfile = task
+    with open(logfile,'w') as logf:
+        subprocess.Popen(["condor_tail","-maxbytes","10000000",jobnum], stdout=logf, stderr=subprocess.PIPE).communicate()
+
+# next backup log number for each stdout name, from one listing of the backup dir (kept for the whole run)
+backup_index = {}
+def getBackupIndex(backup_dir):
+    if backup_dir not in backup_index:
+        nextBackup = {}
+        for fname in os.listdir(backup_dir):
+            name, sep, num = fname.replace(".stdout","").rpartition("_")
+            if len(sep)>0 and num.isdigit():
+                nextBackup[name] = max(nextBackup.get(name,0),int(num)+1)
+        backup_index[backup_dir] = nextBackup
+    return backup_index[backup_dir]
+
+# convert a site name to the corresponding redirector (using the default redirector)
+def getRedir(xrootd):
+    if len(xrootd)==0: return xrootd
+    sitename = ""
+    if xrootd[0] == "T":
+        sitename = xrootd
+        xrootd = parser_dict["manage"]["defaultredir"]
+    if xrootd[-1] != '/':
+        xrootd += '/'
+    if len(sitename)>0:
+        xrootd = xrootd+"/store/test/xrootd/"+sitename
+    return xrootd
+
+# replace the redirector in the job arguments
+def replaceRedir(jobargs,redir):
+    args = jobargs.split(' ')
+    args = [a.replace('"','').rstrip() for a in args]
+    # assumption: "-x" argument used for redirector
+    try:
+        args[args.index("-x")+1] = redir
+    except:
+        args.extend(["-x",redir])
+    return '"'+" ".join(args[:])+'"'
+
+# apply a list of edits (jobnums, attribute, value) in one transaction
+def editJobs(schedd,edits_list):
+    try:
+        with schedd.transaction():
+            for jobnums, attr, value in edits_list:
+                schedd.edit(jobnums,attr,value)
+    except Exception as e:
+        # the transaction is aborted, so apply the edits job by job instead
+        print("Warning: transaction failed ("+str(e)+"), editing jobs individually")
+        for jobnums, attr, value in edits_list:
+            for jobnum in jobnums:
+                schedd.edit([jobnum],attr,value)
+
+# apply an action to all jobs at once
+def actJobs(schedd,action,jobnums):
+    try:
+        schedd.act(action,jobnums)
+    except Exception as e:
+        print("Warning: action failed ("+str(e)+"), applying to jobs individually")
+        for jobnum in jobnums:
+            schedd.act(action,[jobnum])
+
+# redirs: optional dict of job number -> redirector (otherwise options.xrootd is used)
+def resubmitJobs(jobs,options,scheddurl="",coll=None,redirs=None):
     # get scheduler
-    schedd = getSchedd(scheddurl,options.coll)
+    schedd = getSchedd(scheddurl,options.coll if coll is None else coll)
     # process edits from JSON into dict
     edits = {}
     if len(options.edit)>0:
@@ -135,58 +281,96 @@ def resubmitJobs(jobs,options,scheddurl=""):
         if not os.path.isdir(tmp_dir):
             os.mkdir(tmp_dir)
     # actions that must be done per-job
+    logfiles = {}
+    tails = []
     for j in jobs:
         logfile = options.dir+"/"+j.stdout+".stdout"
-        # hold running jobs first (in case hung)
-        if j.status==2:
-            if len(options.dir)>0:
-                logfile = tmp_dir+"/"+j.stdout+".stdout"
-                # generate a backup log from condor_tail
-                cmdt = "condor_tail -maxbytes 10000000 "+j.num
-                with open(logfile,'w') as logf:
-                    subprocess.Popen(cmdt, shell=True, stdout=logf, stderr=subprocess.PIPE).communicate()
-            schedd.act(htcondor.JobAction.Hold,[j.num])
-        # backup log
-        if len(options.dir)>0 and not options.idle:
-            prev_logs = glob.glob(backup_dir+"/"+j.stdout+"_*")
-            num_logs = 0
-            # increment log number if job has been resubmitted before
-            if len(prev_logs)>0:
-                num_logs = max([int(log.split("_")[-1].replace(".stdout","")) for log in prev_logs])+1
-            # copy logfile
+        if j.status==2 and len(options.dir)>0:
+            logfile = tmp_dir+"/"+j.stdout+".stdout"
+            tails.append((j.num,logfile))
+        logfiles[j.num] = logfile
+    # generate backup logs from condor_tail for running jobs, several at a time
+    for (jobnum,logfile), result, error in run_tasks(tailJob, tails, options.threads, options.tailTimeout):
+        if error is not None:
+            print("Warning: could not get log for job "+jobnum+" ("+str(error)+")")
+    # hold running jobs first (in case hung)
+    running = [j.num for j in jobs if j.status==2]
+    if len(running)>0:
+        actJobs(schedd,htcondor.JobAction.Hold,running)
+    # backup logs
+    if len(options.dir)>0 and not options.idle:
+        nextBackup = getBackupIndex(backup_dir)
+        copies = []
+        for j in jobs:
+            logfile = logfiles[j.num]
             if os.path.isfile(logfile):
-                shutil.copy2(logfile,backup_dir+"/"+j.stdout+"_"+str(num_logs)+".stdout")
-        # edit redirector
-        if len(options.xrootd)>0:
-            args = j.args.split(' ')
-            args = [a.replace('"','').rstrip() for a in args]
-            # assumption: "-x" argument used for redirector
-            try:
-                args[args.index("-x")+1] = options.xrootd
-            except:
-                args.extend(["-x",options.xrootd])
-            schedd.edit([j.num],j.argtype,'"'+" ".join(args[:])+'"')
+                # increment log number if job has been resubmitted before
+                num_logs = nextBackup.get(j.stdout,0)
+                nextBackup[j.stdout] = num_logs+1
+                copies.append((logfile,backup_dir+"/"+j.stdout+"_"+str(num_logs)+".stdout"))
+        # copy logfiles
+        for (logfile,backup), result, error in run_tasks(lambda src_dst: shutil.copy2(*src_dst), copies, options.threads):
+            if error is not None:
+                print("Warning: could not back up log "+logfile+" ("+str(error)+")")
+    # edit redirector: jobs with identical new arguments are edited together
+    argEdits = OrderedDict()
+    for j in jobs:
+        redir = redirs.get(j.num,options.xrootd) if redirs is not None else options.xrootd
+        if len(redir)>0:
+            argEdits.setdefault((j.argtype,replaceRedir(j.args,redir)),[]).append(j.num)
+    edits_list = [(jobnums_tmp,argtype,args) for (argtype,args),jobnums_tmp in six.iteritems(argEdits)]
     # actions that can be applied to all jobs
     jobnums = [j.num for j in jobs]
     # reset counts to avoid removal
-    schedd.edit(jobnums,"NumShadowStarts","0")
-    schedd.edit(jobnums,"NumJobStarts","0")
-    schedd.edit(jobnums,"JobRunCount","0")
+    edits_list.extend([
+        (jobnums,"NumShadowStarts","0"),
+        (jobnums,"NumJobStarts","0"),
+        (jobnums,"JobRunCount","0"),
+    ])
     # change sites if desired
-    # takes site list from the first job
+    # takes site list from the first job (or from each job, if redirectors are given per job)
     if len(options.addsites)>0 or len(options.rmsites)>0:
-        sitelist = list(filter(None,jobs[0].sites.split(',')))
-        for addsite in options.addsites:
-            if not addsite in sitelist: sitelist.append(addsite)
-        for rmsite in options.rmsites:
-            if rmsite in sitelist: del sitelist[sitelist.index(rmsite)]
-        schedd.edit(jobnums,"DESIRED_Sites",'"'+','.join(sitelist)+'"')
+        siteEdits = OrderedDict()
+        for j in (jobs if redirs is not None else jobs[:1]):
+            sitelist = list(filter(None,j.sites.split(',')))
+            for addsite in options.addsites:
+                if not addsite in sitelist: sitelist.append(addsite)
+            for rmsite in options.rmsites:
+                if rmsite in sitelist: del sitelist[sitelist.index(rmsite)]
+            siteEdits.setdefault('"'+','.join(sitelist)+'"',[]).append(j.num)
+        if redirs is None:
+            siteEdits = {value: jobnums for value in siteEdits}
+        edits_list.extend([(jobnums_tmp,"DESIRED_Sites",value) for value,jobnums_tmp in six.iteritems(siteEdits)])
     # any other classad edits
     for editname,editval in six.iteritems(edits):
-        schedd.edit(jobnums,str(editname),str(editval))
+        edits_list.append((jobnums,str(editname),str(editval)))
+    editJobs(schedd,edits_list)
     # release jobs (unless idle - then no need to release)
     if not options.idle:
-        schedd.act(htcondor.JobAction.Release,jobnums)
+        actJobs(schedd,htcondor.JobAction.Release,jobnums)
+
+# apply the policy rules to held jobs: release them (possibly with a new redirector or sites) or remove them
+# releases are limited by the release rate for each schedd, and the remaining jobs are left held for the next run
+def applyPolicy(jobs,options,scheddurl,coll,policy):
+    releases, kills, deferred = policy.plan(jobs,scheddurl,not options.dryRun)
+    for rule, rjobs in six.iteritems(releases):
+        print("Releasing {} jobs ({})".format(len(rjobs),rule.describe()))
+        if options.verbose: printJobs(rjobs,options.num,stdout=options.stdout)
+        if options.dryRun: continue
+        roptions = copy.copy(options)
+        roptions.xrootd = getRedir(rule.redirector)
+        roptions.addsites = rule.addsites
+        roptions.rmsites = rule.rmsites
+        resubmitJobs(rjobs,roptions,scheddurl,coll)
+        policy.record(scheddurl,rjobs)
+    if len(kills)>0:
+        print("Removing {} jobs".format(len(kills)))
+        if options.verbose: print("\n".join([(j.stdout if options.stdout else j.name)+(" ("+j.num+")" if options.num else "")+" : "+reason for j,reason in kills]))
+        if not options.dryRun:
+            actJobs(getSchedd(scheddurl,coll),htcondor.JobAction.Remove,[j.num for j,reason in kills])
+            policy.forget(scheddurl,[j for j,reason in kills])
+    if len(deferred)>0:
+        print("Deferring {} jobs (release rate limit)".format(len(deferred)))
 
 def manageJobs(argv=None):
     if argv is None: argv = sys.argv[1:]
@@ -221,11 +405,37 @@ def manageJobs(argv=None):
     group.add_option("-K", "--log_key", dest="logKey", default = "", type="string", help="key to use to find the correct line(s) in the log file (default = %default)")
     group.add_option("-L", "--log_path", dest="logPath", default = os.environ["PWD"], type="string", help = "path to the job logs (default = %default)")
     group.add_option("-U", "--prefer-us-sites", dest="preferUSSites", action = "store_true", default = False, help = "prefer reading inputs from US sites over others (default = %default)")
+    group.add_option("--das-cache", dest="dasCache", default=os.path.expanduser("~/.das_site_cache.json"), type="string", help="file to cache the sites of input files from DAS, empty to disable (default = %default)")
+    group.add_option("--das-ttl", dest="dasTTL", default=24, type="float", help="time in hours to keep the sites of input files in the cache (default = %default)")
     group.add_option("-V", "--verbose", dest="verbose", action = "store_true", default = False, help = "be more verbose when printing out the resubmission information for each job (default = %default)")
     parser.add_option_group(group)
+    group = OptionGroup(parser, "Progress History Options",
+                        "The options for recording the progress of running jobs between runs (--history), used for trends and ETA (-p) and to find stuck jobs (-t).")
+    group.add_option("--history", dest="history", default="", help="database file to record the progress of running jobs (default = %default)")
+    group.add_option("--history-window", dest="historyWindow", default=6, type="float", help="time in hours to compute the recent rate of each job (default = %default)")
+    group.add_option("--history-keep", dest="historyKeep", default=7, type="float", help="time in days to keep the progress of jobs that are no longer running (default = %default)")
+    group.add_option("--stall-events", dest="stallEvents", default=50, type=int, help="a job is stuck if it would have processed this many events at its average rate without any progress (default = %default)")
+    parser.add_option_group(group)
+    group = OptionGroup(parser, "Watch Options",
+                        "The options for following the job event logs (--watch) and printing jobs that are held, evicted, finished, or removed.")
+    group.add_option("--watch", dest="watch", default=False, action="store_true", help="follow the job event logs instead of querying the schedd repeatedly (default = %default)")
+    group.add_option("--watch-dirs", dest="watchDirs", default=["."], type="string", action="callback", callback=list_callback, help="comma-separated list of dirs containing job event logs (*.condor) (default = %default)")
+    group.add_option("--watch-interval", dest="watchInterval", default=10, type="float", help="time in seconds between checks of the job event logs (default = %default)")
+    parser.add_option_group(group)
+    group = OptionGroup(parser, "Policy Options",
+                        "The options for automatically releasing or removing held jobs based on their hold reasons (--policy). The options -D and -V also apply.")
+    group.add_option("--policy", dest="policy", default="", help="JSON file with rules to release or remove held jobs (default = %default)")
+    group.add_option("--policy-db", dest="policyDB", default=os.path.expanduser("~/.manageJobs_policy.db"), help="database file to keep retry counters and release rates between runs (default = %default)")
+    group.add_option("--policy-rate", dest="policyRate", default=60, type="float", help="maximum number of jobs to release per minute for each schedd (default = %default)")
+    group.add_option("--policy-burst", dest="policyBurst", default=100, type=int, help="maximum number of jobs to release at once for each schedd (default = %default)")
+    group.add_option("--policy-interval", dest="policyInterval", default=0, type="float", help="time in seconds between applications of the policy (run as a daemon), 0 to run once (default = %default)")
+    parser.add_option_group(group)
     parser.add_option("--add-sites", dest="addsites", default=[], type="string", action="callback", callback=list_callback, help='comma-separated list of global pool sites to add (default = %default)')
     parser.add_option("--rm-sites", dest="rmsites", default=[], type="string", action="callback", callback=list_callback, help='comma-separated list of global pool sites to remove (default = %default)')
     parser.add_option("--stuck-threshold", dest="stuckThreshold", default=12, help="threshold in hours to define stuck jobs (default = %default)")
+    parser.add_option("--threads", dest="threads", default=8, type=int, help="number of schedds to query (or logs to back up) concurrently (default = %default)")
+    parser.add_option("--timeout", dest="timeout", default=300, type=int, help="timeout in seconds for each schedd query, 0 to disable (default = %default)")
+    parser.add_option("--tail-timeout", dest="tailTimeout", default=300, type=int, help="timeout in seconds for each condor_tail when backing up logs of running jobs, 0 to disable (default = %default)")
     parser.add_option("--ssh", dest="ssh", action="store_true", default=False, help='internal option if script is run recursively over ssh')
     parser.add_option("--help", dest="help", action="store_true", default=False, help='show this help message')
     (options, args) = parser.parse_args(args=argv)
@@ -245,6 +455,12 @@ def manageJobs(argv=None):
         parser.error("Can't use -s and -k together, pick one!")
     if options.xrootdResubmit and options.kill:
         parser.error("Can't use -X and -k together, pick one!")
+    if options.watch and (options.resubmit or options.kill or options.xrootdResubmit or options.finished>0):
+        parser.error("Can't use --watch with -s, -k, -X, or -f!")
+    if len(options.policy)>0 and (options.resubmit or options.kill or options.xrootdResubmit or options.running or options.idle or options.finished>0 or options.watch):
+        parser.error("Can't use --policy with -s, -k, -X, -r, -i, -f, or --watch!")
+    if len(options.policy)>0:
+        options.held = True
     if options.inputFileClassAd and options.logKey:
         parser.error("Can't use -C and -L/-K together, pick one!")
     if options.xrootdResubmit and not options.inputFileClassAd and not options.logKey:
@@ -257,15 +473,7 @@ def manageJobs(argv=None):
         parser.error("Improper xrootd address: "+options.xrootd)
     if len(options.user)==0:
         parser.error("Must specify a user")
-    if len(options.xrootd)>0:
-        sitename = ""
-        if options.xrootd[0] == "T":
-            sitename = options.xrootd
-            options.xrootd = parser_dict["manage"]["defaultredir"]
-        if options.xrootd[-1] != '/':
-            options.xrootd += '/'
-        if len(sitename)>0:
-            options.xrootd = options.xrootd+"/store/test/xrootd/"+sitename
+    options.xrootd = getRedir(options.xrootd)
     if options.ssh or "cmslpc" not in os.uname()[1]: # sometimes "all" shouldn't be used
         options.all = False
     if options.finished>0:
@@ -273,71 +481,121 @@ def manageJobs(argv=None):
         options.kill = False
         options.xrootdResubmit = False
 
-    if options.all: all_nodes = parser_dict["schedds"]["fnal"].split(',')
-    else: all_nodes = [""]
-    for sch in all_nodes:
-        jobs = getJobs(options,sch)
-        if len(jobs)>0:
-            if len(sch)>0: print(sch)
-            if not options.xrootdResubmit: printJobs(jobs,options.num,options.progress,options.stdout,options.why,options.matched)
-
-            # resubmit or remove jobs
-            if options.resubmit:
-                resubmitJobs(jobs,options,sch)
-            elif options.kill:
-                # get scheduler
-                schedd = getSchedd(sch,options.coll)
-                # actions that can be applied to all jobs
-                jobnums = [j.num for j in jobs]
-                schedd.act(htcondor.JobAction.Remove,jobnums)
-            elif options.xrootdResubmit:
-                fprint("")
-                file_and_site_per_file = {}
-                file_and_site_per_file = find_input_file_site_per_job(
-                    blacklisted_sites = options.blacklistedSites,
-                    classad = options.inputFileClassAd,
-                    condor_jobs = jobs,
-                    log_key = options.logKey if options.logKey and options.logPath else "",
-                    log_path = options.logPath if options.logKey and options.logPath else "",
-                    preferred_sites = parser_dict["manage"]["preferredsites"].split(",") if "preferredsites" in parser_dict["manage"].keys() else None,
-                    prefer_us_sites = options.preferUSSites,
-                    verbose = options.verbose,
-                )
-
-                jobs_resubmitted = {}
-                jobs_not_resubmitted = {}
-                if options.verbose:
-                    fprint("Resubmitting jobs (dryRun = " + str(options.dryRun) + ") ...", False)
-                original_xrootd_option = options.xrootd
-                for job, (file, site, sites) in six.iteritems(file_and_site_per_file):
-                    if site is None and not options.xrootd:
-                        jobs_not_resubmitted[job.stdout if options.stdout else job.name] = (file, site, sites)
-                    else:
-                        jobs_resubmitted[job.stdout if options.stdout else job.name] = (file, site, sites)
-                        options.xrootd = site if site is not None else original_xrootd_option
-                        if not options.dryRun:
-                            resubmitJobs([job],options,sch)
-                        options.xrootd = original_xrootd_option
-                if options.verbose:
-                    fprint("DONE\n")
-
-                fprint("Jobs resubmitted:")
-                fmt = "\t{0:>80s}: file={1:<100s} site={2:<20s}"
-                fprint(
-                    "\n".join([
-                        (fmt.format(job,file,site) if options.verbose else "\t" + job)
-                        for job, (file, site, sites) in six.iteritems(jobs_resubmitted)
-                    ])
-                )
-
-                fprint("\nJobs not resubmitted due to lack of an acceptable site:")
-                fmt = "\t{0:>80s}: file={1:<100s} sites={2:<30s}"
-                fprint(
-                    "\n".join([
-                        (fmt.format(job,file,str(sites)) if options.verbose else "\t"+job)
-                        for job, (file, site, sites) in six.iteritems(jobs_not_resubmitted)
-                    ])
-                )
+    if options.watch:
+        watchJobs(options)
+        return
+
+    history = None
+    if len(options.history)>0 and options.finished==0:
+        history = jobHistory(options.history,options.historyWindow,options.historyKeep)
+
+    policy = None
+    if len(options.policy)>0:
+        try:
+            policy = jobPolicy(options.policy,options.policyDB,options.policyRate,options.policyBurst)
+        except ValueError as e:
+            parser.error(str(e))
+
+    while True:
+        # query all schedds at once and handle each one as soon as it answers
+        queryNode = lambda node: getJobs(options,node[1],node[0])
+        for (coll,sch), jobs, error in run_tasks(queryNode, getNodes(options), options.threads, options.timeout):
+            if isinstance(error,TaskTimeout):
+                print("Warning: timed out querying schedd "+sch)
+                continue
+            elif error is not None:
+                print("Warning: could not query schedd "+sch+" ("+str(error)+")")
+                continue
+            if history is not None:
+                history.add(jobs)
+                history.evaluate(jobs)
+                if options.stuck:
+                    for j in jobs: j.why = history.isStuck(j,options.stallEvents,float(options.stuckThreshold))
+                    jobs = [j for j in jobs if len(j.why)>0]
+            if len(jobs)>0:
+                if len(sch)>0: print(sch)
+                if not options.xrootdResubmit and (policy is None or options.verbose): printJobs(jobs,options.num,options.progress,options.stdout,options.why,options.matched)
+                if options.progress and history is not None: printSummary(history.summarize(jobs))
+
+                # resubmit or remove jobs
+                if options.resubmit:
+                    resubmitJobs(jobs,options,sch,coll)
+                elif policy is not None:
+                    applyPolicy(jobs,options,sch,coll,policy)
+                elif options.kill:
+                    # get scheduler
+                    schedd = getSchedd(sch,coll)
+                    # actions that can be applied to all jobs
+                    jobnums = [j.num for j in jobs]
+                    schedd.act(htcondor.JobAction.Remove,jobnums)
+                elif options.xrootdResubmit:
+                    fprint("")
+                    file_and_site_per_file = {}
+                    file_and_site_per_file = find_input_file_site_per_job(
+                        blacklisted_sites = options.blacklistedSites,
+                        classad = options.inputFileClassAd,
+                        condor_jobs = jobs,
+                        log_key = options.logKey if options.logKey and options.logPath else "",
+                        log_path = options.logPath if options.logKey and options.logPath else "",
+                        preferred_sites = parser_dict["manage"]["preferredsites"].split(",") if "preferredsites" in parser_dict["manage"].keys() else None,
+                        prefer_us_sites = options.preferUSSites,
+                        verbose = options.verbose,
+                        nthreads = options.threads,
+                        das_cache = options.dasCache,
+                        das_ttl = options.dasTTL,
+                    )
+
+                    jobs_resubmitted = {}
+                    jobs_not_resubmitted = {}
+                    if options.verbose:
+                        fprint("Resubmitting jobs (dryRun = " + str(options.dryRun) + ") ...", False)
+                    jobs_to_resubmit = []
+                    redirs = {}
+                    for job, (file, site, sites) in six.iteritems(file_and_site_per_file):
+                        if site is None and not options.xrootd:
+                            jobs_not_resubmitted[job.stdout if options.stdout else job.name] = (file, site, sites)
+                        else:
+                            jobs_resubmitted[job.stdout if options.stdout else job.name] = (file, site, sites)
+                            jobs_to_resubmit.append(job)
+                            redirs[job.num] = site if site is not None else options.xrootd
+                    # resubmit all jobs together, grouped by redirector
+                    if not options.dryRun and len(jobs_to_resubmit)>0:
+                        resubmitJobs(jobs_to_resubmit,options,sch,coll,redirs)
+                    if options.verbose:
+                        fprint("DONE\n")
+
+                    fprint("Jobs resubmitted:")
+                    fmt = "\t{0:>80s}: file={1:<100s} site={2:<20s}"
+                    fprint(
+                        "\n".join([
+                            (fmt.format(job,file,site) if options.verbose else "\t" + job)
+                            for job, (file, site, sites) in six.iteritems(jobs_resubmitted)
+                        ])
+                    )
+
+                    fprint("\nJobs not resubmitted due to lack of an acceptable site:")
+                    fmt = "\t{0:>80s}: file={1:<100s} sites={2:<30s}"
+                    fprint(
+                        "\n".join([
+                            (fmt.format(job,file,str(sites)) if options.verbose else "\t"+job)
+                            for job, (file, site, sites) in six.iteritems(jobs_not_resubmitted)
+                        ])
+                    )
+
+        # run once, unless applying a policy as a daemon
+        if policy is None or options.policyInterval<=0: break
+        try:
+            time.sleep(options.policyInterval)
+        except KeyboardInterrupt:
+            break
+        # locate schedds and list backup logs again, in case they changed
+        schedd_cache.clear()
+        backup_index.clear()
+
+    if policy is not None:
+        policy.close()
+    if history is not None:
+        history.close()
 
 if __name__=="__main__":
     manageJobs()
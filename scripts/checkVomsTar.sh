@@ -21,15 +21,75 @@ if [ -z "$NOVOMS" ] && ! voms-proxy-info -exists; then
 	voms-proxy-init -voms cms --valid 168:00
 fi
 
+TARNAME=${CMSSW_VERSION}.tar.gz
+MANIFEST=.${TARNAME}.manifest
+# the tarball and manifest may be inside the CMSSW area
+TARFLAGS="--exclude-caches-all --exclude-vcs --exclude=${TARNAME} --exclude=${TARNAME}.tmp --exclude=${MANIFEST} --exclude=${MANIFEST}.new"
+
 # tarball of CMSSW area
 if [ -z "$KEEPTAR" ]; then
-	tar --exclude-caches-all --exclude-vcs -zcf ${CMSSW_VERSION}.tar.gz -C ${CMSSW_BASE}/.. ${CMSSW_VERSION}
+	# list files with sizes and modification times (without reading them) to check for changes since the last tarball
+	# (sorted, and directory times are dropped: they change when files are added or removed, which is already in the list)
+	tar ${TARFLAGS} --full-time -cvvf /dev/null -C ${CMSSW_BASE}/.. ${CMSSW_VERSION} 2>/dev/null | sed -E '/^d/ s/^(\S+\s+\S+\s+\S+)\s+\S+\s+\S+/\1/' | LC_ALL=C sort > ${MANIFEST}.new
+	if [ ${PIPESTATUS[0]} -ne 0 ]; then
+		rm -f ${MANIFEST}.new
+	fi
+	if [ -e ${TARNAME} ] && [ -s ${MANIFEST}.new ] && cmp -s ${MANIFEST} ${MANIFEST}.new; then
+		echo "CMSSW area unchanged, keeping existing ${TARNAME}"
+		rm -f ${MANIFEST}.new
+	else
+		# parallel compression if available
+		COMPRESS=gzip
+		if type pigz >& /dev/null; then
+			COMPRESS=pigz
+		fi
+		tar ${TARFLAGS} -cf - -C ${CMSSW_BASE}/.. ${CMSSW_VERSION} | ${COMPRESS} > ${TARNAME}.tmp
+		TARSTATUS=("${PIPESTATUS[@]}")
+		if [ ${TARSTATUS[0]} -eq 0 ] && [ ${TARSTATUS[1]} -eq 0 ]; then
+			mv ${TARNAME}.tmp ${TARNAME}
+			if [ -e ${MANIFEST}.new ]; then
+				mv ${MANIFEST}.new ${MANIFEST}
+			fi
+		else
+			echo "ERROR Failed to make ${TARNAME}"
+			rm -f ${TARNAME}.tmp ${MANIFEST}.new ${MANIFEST}
+			exit 1
+		fi
+	fi
 fi
 
-if [ -e ${CMSSW_VERSION}.tar.gz ]; then
-	ls -lth ${CMSSW_VERSION}.tar.gz
+if [ -e ${TARNAME} ]; then
+	ls -lth ${TARNAME}
 fi
 
+# adler32 checksums (lowercase, zero-padded) to check if upload is needed
+normChecksum(){
+	printf "%8s" "$(echo $1 | tr 'A-F' 'a-f')" | tr ' ' '0'
+}
+
+localChecksum(){
+	if type xrdadler32 >& /dev/null; then
+		normChecksum $(xrdadler32 ${TARNAME} 2> /dev/null | cut -d' ' -f1)
+	fi
+}
+
+remoteChecksum(){
+	if [[ "${XRDIR}" == *"root://"* ]]; then
+		XRDREST=${XRDIR#root://}
+		XRDHOST=${XRDREST%%/*}
+		XRDPATH=${XRDREST#*/}
+		CHECKSUM=($(xrdfs root://${XRDHOST} query checksum ${XRDPATH}/${TARNAME} 2> /dev/null))
+		if [ "${CHECKSUM[0]}" = "adler32" ]; then
+			normChecksum ${CHECKSUM[1]}
+		fi
+	elif [[ "${XRDIR}" == *"gsiftp://"* ]]; then
+		CHECKSUM=($(env -i X509_USER_PROXY=${X509_USER_PROXY} gfal-sum ${XRDIR}/${TARNAME} ADLER32 2> /dev/null))
+		if [ -n "${CHECKSUM[1]}" ]; then
+			normChecksum ${CHECKSUM[1]}
+		fi
+	fi
+}
+
 if [[ "${XRDIR}" == *"root://"* ]]; then
 	CMD="xrdcp"
 elif [[ "${XRDIR}" == *"gsiftp://"* ]]; then
@@ -40,5 +100,10 @@ elif [[ -n "${XRDIR}" ]]; then
 fi
 
 if [ -n "$XRDIR" ] && [ -n "$CMD" ]; then
-	${CMD} -f ${CMSSW_VERSION}.tar.gz ${XRDIR}/${CMSSW_VERSION}.tar.gz
+	LOCALSUM=$(localChecksum)
+	if [ -n "$LOCALSUM" ] && [ "$LOCALSUM" = "$(remoteChecksum)" ]; then
+		echo "${XRDIR}/${TARNAME} is up to date (adler32 ${LOCALSUM}), skipping upload"
+	else
+		${CMD} -f ${TARNAME} ${XRDIR}/${TARNAME}
+	fi
 fi
@@ -28,6 +28,9 @@ stageOut() {
 	REMOVE=0
 	CLEANUP=""
 	REVERSE=0
+	BULK=0
+	NPARALLEL=4
+	CKSUM=0
 
 	stageOut_usage() {
 		case `uname` in
@@ -35,12 +38,12 @@ stageOut() {
 			*) ECHO="echo" ;;
 		esac
 
-		$ECHO "stageOut [options]"
+		$ECHO "stageOut [options] [files]"
 		$ECHO ""
 		$ECHO "Options:"
-		$ECHO "-i input      \tinput file name (required)"
-		$ECHO "-o output     \toutput file name (required)"
-		$ECHO "-w wait       \twait time in seconds (default = $WAIT)"
+		$ECHO "-i input      \tinput file name (required unless bulk)"
+		$ECHO "-o output     \toutput file name (required; output directory if bulk)"
+		$ECHO "-w wait       \tinitial wait time in seconds, doubled (with random jitter) for each retry (default = $WAIT)"
 		$ECHO "-n num        \tnumber of repetitions (default = $NUMREP)"
 		$ECHO "-x args       \tany arguments to pass to xrdcp/gfal-copy (should be quoted)"
 		$ECHO "-g            \tUse gfal-copy rather than xrdcp"
@@ -48,11 +51,105 @@ stageOut() {
 		$ECHO "-r            \tremove local file if successfully copied"
 		$ECHO "-c files      \tcleanup: delete specified file(s) if copy fails"
 		$ECHO "-R            \treverse (stagein): swap input and output"
+		$ECHO "-l            \tbulk: copy all files given as arguments to output directory"
+		$ECHO "-p num        \tnumber of parallel transfers in bulk mode (default = $NPARALLEL)"
+		$ECHO "-k            \tverify adler32 checksum of copied file(s)"
+	}
+
+	# size or adler32 checksum of a local or remote file (empty if unavailable)
+	stageOut_stat() {
+		local WHAT="$1"
+		local URL="$2"
+		local VAL=""
+		case "$URL" in
+			*://*)
+				if [ $GFAL -eq 1 ]; then
+					if [ "$WHAT" = "size" ]; then
+						VAL=$(env -i X509_USER_PROXY=${X509_USER_PROXY} gfal-stat $URL 2> /dev/null | awk '/Size:/{print $2}')
+					else
+						VAL=$(env -i X509_USER_PROXY=${X509_USER_PROXY} gfal-sum $URL ADLER32 2> /dev/null | awk '{print $2}')
+					fi
+				else
+					local REDIR=$(echo $URL | sed 's~^\([^:]*://[^/]*\)/.*~\1~')
+					local LFN=${URL#$REDIR}
+					if [ "$WHAT" = "size" ]; then
+						VAL=$(xrdfs $REDIR stat $LFN 2> /dev/null | awk '/Size:/{print $2}')
+					else
+						VAL=$(xrdfs $REDIR query checksum $LFN 2> /dev/null | awk '$1=="adler32"{print $2}')
+					fi
+				fi
+			;;
+			*)
+				if [ ! -f "$URL" ]; then return; fi
+				if [ "$WHAT" = "size" ]; then
+					VAL=$(stat -c %s $URL)
+				else
+					VAL=$(xrdadler32 $URL 2> /dev/null | cut -d' ' -f1)
+				fi
+			;;
+		esac
+		if [ "$WHAT" = "size" ] || [ -z "$VAL" ]; then
+			echo $VAL
+		else
+			printf "%8s" "$(echo $VAL | tr 'A-F' 'a-f')" | tr ' ' '0'
+		fi
+	}
+
+	# check if a file was already copied completely (used to retry only the failed files in bulk mode)
+	stageOut_done() {
+		local DSTSIZE=$(stageOut_stat size $2)
+		if [ -z "$DSTSIZE" ] || [ "$DSTSIZE" != "$(stageOut_stat size $1)" ]; then return 1; fi
+		if [ $CKSUM -eq 1 ]; then
+			local DSTSUM=$(stageOut_stat adler32 $2)
+			[ -n "$DSTSUM" ] && [ "$DSTSUM" = "$(stageOut_stat adler32 $1)" ]
+			return $?
+		fi
+		return 0
+	}
+
+	# copy pending files, grouped by destination directory, with a limited number of parallel transfers
+	stageOut_bulk() {
+		local EXIT=0
+		local DSTDIR IDX J K PIDS PID FILELIST FILELISTS DSTURL
+		for DSTDIR in $(for IDX in ${PENDING[@]}; do dirname ${DSTS[$IDX]}; done | sort -u); do
+			local GROUP=()
+			for IDX in ${PENDING[@]}; do
+				if [ "$(dirname ${DSTS[$IDX]})" = "$DSTDIR" ]; then GROUP+=(${SRCS[$IDX]}); fi
+			done
+			if [ $GFAL -eq 1 ]; then
+				# gfal-copy processes its list serially, so split the list between parallel processes
+				PIDS=()
+				FILELISTS=()
+				for ((J=0; J < $NPARALLEL && J < ${#GROUP[@]}; J++)); do
+					FILELIST=$(mktemp)
+					FILELISTS+=($FILELIST)
+					for ((K=$J; K < ${#GROUP[@]}; K+=$NPARALLEL)); do
+						case "${GROUP[$K]}" in
+							*://*) echo ${GROUP[$K]} ;;
+							*) echo file://$(realpath ${GROUP[$K]}) ;;
+						esac
+					done > $FILELIST
+					case "$DSTDIR" in
+						*://*) DSTURL=$DSTDIR/ ;;
+						*) DSTURL=file://$(realpath $DSTDIR)/ ;;
+					esac
+					env -i X509_USER_PROXY=${X509_USER_PROXY} gfal-copy $CKSUMARGS $XRDARGS --from-file $FILELIST $DSTURL &
+					PIDS+=($!)
+				done
+				for PID in ${PIDS[@]}; do
+					wait $PID || EXIT=$?
+				done
+				rm -f ${FILELISTS[@]}
+			else
+				xrdcp --parallel $NPARALLEL $CKSUMARGS $XRDARGS ${GROUP[@]} $DSTDIR/ || EXIT=$?
+			fi
+		done
+		return $EXIT
 	}
 
 	# set vars used by getopts to local
 	local OPTIND OPTARG
-	while getopts "i:o:w:n:x:gqrc:R" opt; do
+	while getopts "i:o:w:n:x:gqrc:Rlp:k" opt; do
 		case "$opt" in
 			i) INPUT="$OPTARG"
 			;;
@@ -75,39 +172,97 @@ stageOut() {
 			;;
 			R) REVERSE=1
 			;;
+			l) BULK=1
+			;;
+			p) NPARALLEL="$OPTARG"
+			;;
+			k) CKSUM=1
+			;;
 		esac
 	done
+	shift $((OPTIND-1))
 
-	if [[ -z "$INPUT" ]] || [[ -z "$OUTPUT" ]]; then
+	if [[ -z "$OUTPUT" ]] || ( [ $BULK -eq 0 ] && [[ -z "$INPUT" ]] ) || ( [ $BULK -eq 1 ] && [ $# -eq 0 ] ); then
 		stageOut_usage
 		return 1
 	fi
 
-	if [ "$REVERSE" -eq 1 ]; then
-		TMPPUT="$INPUT"
-		INPUT="$OUTPUT"
-		OUTPUT="$TMPPUT"
-		# ensure expected output directory exists
-		mkdir -p $(dirname $OUTPUT)
+	CKSUMARGS=""
+	if [ $CKSUM -eq 1 ]; then
+		if [ $GFAL -eq 1 ]; then
+			CKSUMARGS="-K ADLER32"
+		else
+			CKSUMARGS="--cksum adler32:source"
+		fi
 	fi
 
-	# try to copy n times, increasing wait each time
-	TMPWAIT=0
+	# list of sources and destinations
+	SRCS=()
+	DSTS=()
+	if [ $BULK -eq 1 ]; then
+		# files keep their names in the output directory
+		for FILE in "$@"; do
+			if [ "$REVERSE" -eq 1 ]; then
+				SRCS+=(${OUTPUT%/}/$(basename $FILE))
+				DSTS+=($FILE)
+				mkdir -p $(dirname $FILE)
+			else
+				SRCS+=($FILE)
+				DSTS+=(${OUTPUT%/}/$(basename $FILE))
+			fi
+		done
+	else
+		if [ "$REVERSE" -eq 1 ]; then
+			TMPPUT="$INPUT"
+			INPUT="$OUTPUT"
+			OUTPUT="$TMPPUT"
+			# ensure expected output directory exists
+			mkdir -p $(dirname $OUTPUT)
+		fi
+		SRCS=($INPUT)
+		DSTS=($OUTPUT)
+	fi
+	PENDING=(${!SRCS[@]})
+
+	# try to copy n times, doubling wait each time
+	# random jitter avoids many jobs retrying in lockstep after a storage interruption
+	TMPWAIT=$WAIT
 	for ((i=0; i < $NUMREP; i++)); do
-		if [ $GFAL -eq 1 ]; then
-			env -i X509_USER_PROXY=${X509_USER_PROXY} gfal-copy $XRDARGS $INPUT $OUTPUT
+		if [ $BULK -eq 1 ]; then
+			stageOut_bulk
+		elif [ $GFAL -eq 1 ]; then
+			env -i X509_USER_PROXY=${X509_USER_PROXY} gfal-copy $CKSUMARGS $XRDARGS $INPUT $OUTPUT
 		else
-			xrdcp $XRDARGS $INPUT $OUTPUT
+			xrdcp $CKSUMARGS $XRDARGS $INPUT $OUTPUT
 		fi
 		XRDEXIT=$?
+		if [ $XRDEXIT -ne 0 ] && [ $BULK -eq 1 ]; then
+			# keep only files that were not copied
+			PENDING_TMP=()
+			for IDX in ${PENDING[@]}; do
+				if ! stageOut_done ${SRCS[$IDX]} ${DSTS[$IDX]}; then PENDING_TMP+=($IDX); fi
+			done
+			PENDING=(${PENDING_TMP[@]})
+			if [ ${#PENDING[@]} -eq 0 ]; then XRDEXIT=0; fi
+		fi
 		if [ $XRDEXIT -eq 0 ]; then
-			if [ $REMOVE -eq 1 ]; then rm $INPUT; fi
+			# keep track of bytes copied (e.g. for chain timing reports)
+			if [ -n "$STAGEOUT_LOG" ]; then
+				if [ "$REVERSE" -eq 1 ]; then LOCALS=(${DSTS[@]}); else LOCALS=(${SRCS[@]}); fi
+				stat -c %s ${LOCALS[@]} 2> /dev/null | awk '{ sum += $1 } END { print sum+0 }' >> ${STAGEOUT_LOG}
+			fi
+			if [ $REMOVE -eq 1 ]; then rm ${SRCS[@]}; fi
 			return 0
 		fi
+		if [ $((i+1)) -ge $NUMREP ]; then break; fi
 		# in case of bad exit, wait and try again
-		TMPWAIT=$(($TMPWAIT + $WAIT))
-		if [ $QUIET -eq 0 ]; then echo "Exit code $XRDEXIT, failure in $CMDSTR. Retry after $TMPWAIT seconds..."; fi
-		sleep $TMPWAIT
+		SLEEPTIME=$(($TMPWAIT - $RANDOM % ($TMPWAIT/2 + 1)))
+		if [ $QUIET -eq 0 ]; then
+			if [ $BULK -eq 1 ]; then echo "${#PENDING[@]} of ${#SRCS[@]} files not copied."; fi
+			echo "Exit code $XRDEXIT, failure in $CMDSTR. Retry after $SLEEPTIME seconds..."
+		fi
+		sleep $SLEEPTIME
+		TMPWAIT=$(($TMPWAIT * 2))
 	done
 
 	# if we get here, it really didn't work
@@ -4,7 +4,8 @@ JOBNAME=""
 NJOBS=0
 PROCESS=""
 CHECKPOINT=""
-while getopts "J:N:P:C" opt; do
+TIMING=""
+while getopts "J:N:P:CT" opt; do
 	case "$opt" in
 		J) JOBNAME=$OPTARG
 		;;
@@ -14,12 +15,66 @@ while getopts "J:N:P:C" opt; do
 		;;
 		C) CHECKPOINT=1
 		;;
+		T) TIMING=1
+		;;
 	esac
 done
 FIRST_STEP=0
 
+# timing report: wall time, exit code, and bytes staged for each phase
+# written as JSON when the script exits (returned via condor file transfer)
+TIMING_OUT=${PWD}/timing_${JOBNAME}_${PROCESS}.json
+TIMING_STEPS=()
+if [ -n "$TIMING" ]; then
+	# stageOut adds the number of bytes copied to this file
+	export STAGEOUT_LOG=${PWD}/.stageout_${JOBNAME}_${PROCESS}.txt
+	# make sure output file exists (in case the job is killed)
+	echo "{}" > ${TIMING_OUT}
+fi
+
+timeStart() {
+	TIMING_T0=$(date +%s.%N)
+	if [ -n "$STAGEOUT_LOG" ]; then : > ${STAGEOUT_LOG}; fi
+}
+
+# usage: timeEnd step name exitcode [bytes]
+timeEnd() {
+	local T1=$(date +%s.%N)
+	local BYTES=${4:-0}
+	if [ -n "$STAGEOUT_LOG" ] && [ -s ${STAGEOUT_LOG} ]; then
+		BYTES=$(awk -v sum=$BYTES '{ sum += $1 } END { printf "%d", sum }' ${STAGEOUT_LOG})
+	fi
+	TIMING_STEPS+=("$(printf '{"step": "%s", "name": "%s", "start": %.3f, "wall": %.3f, "exit": %d, "bytes": %d}' \
+		"$1" "$2" $TIMING_T0 $(awk "BEGIN { print $T1 - $TIMING_T0 }") $3 $BYTES)")
+}
+
+writeTiming() {
+	EXITCODE=$?
+	if [ -z "$TIMING" ]; then return; fi
+	(
+	printf '{"job": "%s", "process": "%s", "host": "%s", "exit": %d, "steps": [' "$JOBNAME" "$PROCESS" "$(hostname)" $EXITCODE
+	SEP=""
+	for STEP in "${TIMING_STEPS[@]}"; do
+		printf '%s\n  %s' "$SEP" "$STEP"
+		SEP=","
+	done
+	printf '\n]}\n'
+	) > ${TIMING_OUT}
+	rm -f ${STAGEOUT_LOG}
+}
+trap writeTiming EXIT
+
+timeStart
 # open aggregate tarball
 tar -xzf ${JOBNAME}.tar.gz
+UNPACKEXIT=$?
+UNPACKBYTES=$(stat -c %s ${JOBNAME}.tar.gz)
+# open per-process tarball, if any (adds files to the job directories)
+if [ -f ${JOBNAME}_${PROCESS}.tar.gz ]; then
+	tar -xzf ${JOBNAME}_${PROCESS}.tar.gz || UNPACKEXIT=$?
+	UNPACKBYTES=$((UNPACKBYTES + $(stat -c %s ${JOBNAME}_${PROCESS}.tar.gz)))
+fi
+timeEnd unpack ${JOBNAME} $UNPACKEXIT $UNPACKBYTES
 
 # for checkpoints
 TOPDIR=$PWD
@@ -70,8 +125,10 @@ for ((i=${FIRST_STEP}; i<${NJOBS}; i++)); do
 		# -> existing CHECKPOINT_OUT will be kept if next step fails again
 		echo "Recovering output from ${JOB_CURR} ($JNAME)"
 		# need to get env from step1.sh?
+		timeStart
 		source ${CHECKPOINT_IN}
 		CHECKEXIT=$?
+		timeEnd recover ${JNAME} $CHECKEXIT
 		if [[ $CHECKEXIT -ne 0 ]]; then
 			echo "exit code $CHECKEXIT, failure recovering output from ${JOB_CURR}"
 			exit $CHECKEXIT
@@ -84,19 +141,23 @@ for ((i=${FIRST_STEP}; i<${NJOBS}; i++)); do
 		echo "source jobExecCondor.sh" >> ${CHECKPOINT_CURR}
 
 		echo "Executing ${JOB_CURR} ($JNAME)"
+		timeStart
 		./jobExecCondor.sh $ARGS
 		JOBEXIT=$?
+		timeEnd ${JOB_CURR} ${JNAME} $JOBEXIT
 		if [[ $JOBEXIT -ne 0 ]]; then
 			# if first job failed, nothing to checkpoint
 			if [ -n "$CHECKPOINT" ] && [ -n "$CHECKPOINT_PREV" ]; then
 				# checkpoint: stageout files from previous step
 				echo "Making checkpoint for ${JOB_PREV}"
 				# in subshell just to be safe
+				timeStart
 				(
 				cd ${JOBDIR_BASE}/${JOB_PREV}
 				source ${CHECKPOINT_PREV}
 				)
 				CHEXIT=$?
+				timeEnd checkpoint $(cat ${JOBDIR_BASE}/${JOB_PREV}/jobname.txt) $CHEXIT
 				if [[ $CHEXIT -ne 0 ]]; then
 					# keep previous checkpoint, if any, in this case
 					echo "Failed to make checkpoint (exit code $CHEXIT)"
@@ -9,11 +9,13 @@ echo "CMSSW on Condor"
 export CMSSWVER=""
 export CMSSWLOC=""
 export CMSSWXRD=""
+export CMSSWCACHE=""
+export CMSSWCACHEMAX=""
 export OPTIND=1
 while [[ $OPTIND -le $# ]]; do
 	# getopts in silent mode, don't exit on errors
 	OPTOLD=$OPTIND
-	getopts ":C:L:X:" opt
+	getopts ":C:L:X:K:M:" opt
 	case "$opt" in
 		C) export CMSSWVER=$OPTARG
 		;;
@@ -21,6 +23,10 @@ while [[ $OPTIND -le $# ]]; do
 		;;
 		X) export CMSSWXRD=$OPTARG
 		;;
+		K) export CMSSWCACHE=$OPTARG
+		;;
+		M) export CMSSWCACHEMAX=$OPTARG
+		;;
 		# keep going if getopts had an error, but make sure not to skip anything
 		\? | :) OPTIND=$((OPTOLD+1))
 		;;
@@ -36,6 +42,12 @@ fi
 if [ -n "$CMSSWXRD" ]; then
 	echo "CMSSWXRD: $CMSSWXRD"
 fi
+if [ -n "$CMSSWCACHE" ]; then
+	echo "CMSSWCACHE: $CMSSWCACHE"
+fi
+if [ -n "$CMSSWCACHEMAX" ]; then
+	echo "CMSSWCACHEMAX: $CMSSWCACHEMAX"
+fi
 echo ""
 
 # to get condor-chirp from CMSSW
@@ -57,9 +69,83 @@ elif [ -n "$CMSSWLOC" ]; then
 	export SCRAM_ARCH=${CMSSWLOC}
 fi
 
+# node-local cache of unpacked CMSSW areas, keyed by tarball checksum and shared by jobs on the same node
+# the cache is checked with a shared lock and filled (or old entries evicted) with an exclusive lock; entries are copied without the lock
+getCachedCMSSW(){
+	if ! type flock >& /dev/null; then
+		return 1
+	fi
+	local CACHEKEY CACHEDIR
+	CACHEKEY=$(md5sum ${CMSSWVER}.tar.gz | cut -d' ' -f1)
+	if [ -z "$CACHEKEY" ]; then
+		return 1
+	fi
+	CACHEDIR=${CMSSWCACHE}/${CMSSWVER}_${CACHEKEY}
+	mkdir -p ${CMSSWCACHE} || return 1
+	(
+	# checking the cache only needs a shared lock, so jobs on the same node can use it at the same time
+	if ! flock -s -w 1800 9; then
+		echo "Timed out waiting for CMSSW cache lock"
+		exit 1
+	fi
+	if [ ! -e ${CACHEDIR}/.ready ]; then
+		# exclusive lock to fill the cache (checked again, another job may have filled it while waiting)
+		if ! flock -x -w 1800 9; then
+			echo "Timed out waiting for CMSSW cache lock"
+			exit 1
+		fi
+		if [ ! -e ${CACHEDIR}/.ready ]; then
+			echo "Filling CMSSW cache ${CACHEDIR}"
+			# remove incomplete entries (e.g. from failed jobs)
+			for OLDDIR in ${CMSSWCACHE}/*/; do
+				if [ -d "$OLDDIR" ] && [ ! -e ${OLDDIR}/.ready ]; then
+					rm -rf ${OLDDIR}
+				fi
+			done
+			if ! (mkdir -p ${CACHEDIR} && tar -xzf ${CMSSWVER}.tar.gz -C ${CACHEDIR} && cd ${CACHEDIR}/${CMSSWVER} && scram b ProjectRename && scram b ExternalLinks); then
+				rm -rf ${CACHEDIR}
+				exit 1
+			fi
+			touch ${CACHEDIR}/.ready
+			# evict least recently used entries if the cache is too large
+			if [ -n "$CMSSWCACHEMAX" ]; then
+				while [ $(du -sm ${CMSSWCACHE} | cut -f1) -gt $((CMSSWCACHEMAX*1024)) ]; do
+					OLDDIR=$(dirname $(ls -t ${CMSSWCACHE}/*/.ready | tail -n 1))
+					if [ "$OLDDIR" = "$CACHEDIR" ]; then
+						break
+					fi
+					echo "Evicting $OLDDIR from CMSSW cache"
+					# renamed first, so a job still copying from it fails instead of getting an incomplete copy
+					mv $OLDDIR ${OLDDIR}.evicted || break
+					rm -rf ${OLDDIR}.evicted
+				done
+			fi
+		fi
+	fi
+	# mark as recently used
+	touch ${CACHEDIR}/.ready
+	) 9>${CMSSWCACHE}/.lock || return 1
+	# copy without holding the lock, and check that the entry was not evicted in the meantime
+	cp -a ${CACHEDIR}/${CMSSWVER} . && [ -e ${CACHEDIR}/.ready ] || return 1
+	# the private copy is relocated to the job directory, but external links are kept
+	(cd ${CMSSWVER} && scram b ProjectRename)
+}
+
 # use a tarball if we have it, otherwise make a new release area
+USECACHE=""
+if [ -n "$CMSSWCACHE" ] && [ -e ${CMSSWVER}.tar.gz ] && [ -z "$CMSSWLOC" ]; then
+	echo "Getting CMSSW from node cache"
+	if getCachedCMSSW; then
+		USECACHE=1
+	else
+		echo "Could not use CMSSW cache, unpacking tarball"
+		rm -rf ${CMSSWVER}
+	fi
+fi
 set -e
-if [ -e ${CMSSWVER}.tar.gz ]; then
+if [ -n "$USECACHE" ]; then
+	cd ${CMSSWVER}
+elif [ -e ${CMSSWVER}.tar.gz ]; then
 	# workaround
 	if [ -n "$CMSSWLOC" ]; then
 		mkdir tmp
@@ -0,0 +1,43 @@
+from __future__ import print_function
+import os, tempfile
+from Condor.Production.jobLedger import jobLedger
+
+# checks that the ledger keeps finished jobs across runs of missing mode,
+# including jobs that are finished but still in the queue (e.g. resubmitted before the output appeared)
+
+def check(label,result,expected):
+    if result!=expected:
+        raise AssertionError(label+": expected "+str(sorted(expected))+", got "+str(sorted(result)))
+    print(label+": OK")
+
+if __name__=="__main__":
+    fd, fname = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        # first run: full listing finds job_0 and job_1 (job_1 is still queued), job_2 is missing and resubmitted
+        ledger = jobLedger(fname)
+        ledger.resetFinished(["job_0","job_1"])
+        check("first run finished",ledger.getFinished(),{"job_0","job_1"})
+        ledger.close()
+
+        # second run: incremental listing finds no new files, job_1 and job_2 are still queued
+        ledger = jobLedger(fname)
+        ledger.setFinished([])
+        check("finished but still queued",ledger.getFinished(),{"job_0","job_1"})
+        ledger.close()
+
+        # third run: job_1 left the queue, job_2 finished, logs of job_0 archived
+        ledger = jobLedger(fname)
+        ledger.setFinished(["job_2"])
+        ledger.setCleaned(["job_0"])
+        check("finished after queue empties",ledger.getFinished(),{"job_0","job_1","job_2"})
+        check("cleaned",ledger.getFinished(cleaned=True),{"job_0"})
+        ledger.close()
+
+        # full listing again (--ledger-reset) after job_1 output was removed: cleaned jobs are kept
+        ledger = jobLedger(fname)
+        ledger.resetFinished(["job_2"])
+        check("full listing",ledger.getFinished(),{"job_0","job_2"})
+        ledger.close()
+    finally:
+        os.remove(fname)
@@ -0,0 +1,52 @@
+from __future__ import print_function
+import os, shutil, tempfile
+from Condor.Production.jobWatcher import jobWatcher
+
+# replays a recorded event log (jobWatcherTest/test_123.condor) through the watcher used by manageJobs --watch:
+# the log is written in two parts, and only the new events should be reported after the second part
+# then a schedd query that no longer has a job still running in the log should mark it as finished
+
+def check(label,result,expected):
+    if result!=expected:
+        raise AssertionError(label+": expected "+str(expected)+", got "+str(result))
+    print(label+": OK")
+
+def whats(transitions):
+    return [(t.job.num,t.what) for t in transitions]
+
+if __name__=="__main__":
+    recorded = os.path.join(os.path.dirname(os.path.abspath(__file__)),"jobWatcherTest","test_123.condor")
+    with open(recorded) as rfile:
+        events = [event+"...\n" for event in rfile.read().split("...\n") if len(event)>0]
+    # submit, execute (both jobs), held (first job)
+    nfirst = 5
+
+    logdir = tempfile.mkdtemp()
+    logname = os.path.join(logdir,os.path.basename(recorded))
+    ads = []
+    watcher = jobWatcher([logdir],lambda: ads)
+    try:
+        with open(logname,'w') as lfile:
+            lfile.write("".join(events[:nfirst]))
+        check("first part",whats(watcher.update()),[("123.0","held")])
+        check("first part states",watcher.counts(),{2:1,5:1})
+        check("hold reason",watcher.jobs["123.0"].why,"Error from slot1@node: Transfer input files failure")
+
+        # released, executing, evicted (second job), finished (first job)
+        with open(logname,'a') as lfile:
+            lfile.write("".join(events[nfirst:]))
+        check("second part (new events only)",whats(watcher.update()),[("123.1","evicted"),("123.0","finished")])
+        check("second part states",watcher.counts(),{2:1,4:1})
+        check("unchanged log",whats(watcher.update()),[])
+
+        # the second job left the queue without a terminal event in the log
+        check("jobs changed by sync",watcher.sync(),1)
+        check("states after sync",watcher.counts(),{4:2})
+
+        # removed log: no longer watched
+        os.remove(logname)
+        watcher.update()
+        check("removed log",len(watcher.logs),0)
+    finally:
+        watcher.close()
+        shutil.rmtree(logdir)